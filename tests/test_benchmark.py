@@ -0,0 +1,213 @@
+__author__ = 'tla'
+
+import unittest
+
+from tpen2tei.wordtokenize import Tokenizer, Normaliser, BlockCache, WitnessCache, milestone_index
+from lxml import etree
+
+from config import config as config
+import copy
+import gc
+import math
+import os
+import tempfile
+import time
+
+# The benchmarks take a while, so they are only run when asked for, e.g. with
+#   TPEN2TEI_BENCHMARK=1 python -m pytest tests/test_benchmark.py -s
+# The value can also be a list of the sizes to try, e.g. TPEN2TEI_BENCHMARK=1,10
+BENCHMARK = os.environ.get('TPEN2TEI_BENCHMARK')
+
+# How much faster than linear the time taken may grow from one size to the next,
+# as an exponent: with 1.3, ten times the text may take up to twenty times as long.
+MAX_EXPONENT = 1.3
+
+# Timings shorter than this are repeated, and the best of them taken.
+MIN_TIME = 0.5
+
+# How much longer than at the smallest size a single section near the start of the
+# text may take at the larger sizes, over and above lxml's passes through the whole
+# document for its blocks and milestones: i.e., the rest should hardly grow at all.
+MAX_FLAT = 2
+
+
+def synthetic_witness(source, scale):
+    """Build a TEI document whose text is that of the source document, as many times
+    over as scale says, each time in a block of its own. The milestones and IDs of
+    each copy are made unique, and every tenth abbreviation is given an expansion
+    in a <choice>, so that all the markup the tokenizer deals with turns up."""
+    doc = copy.deepcopy(source)
+    tei_ns = '{http://www.tei-c.org/ns/1.0}'
+    body = doc.find('.//%sbody' % tei_ns)
+    blocks = list(body)
+    for child in blocks:
+        body.remove(child)
+    for i in range(scale):
+        for block in blocks:
+            block = copy.deepcopy(block)
+            for el in block.iter('%smilestone' % tei_ns):
+                el.set('n', '%s.%d' % (el.get('n'), i))
+            for el in block.iter():
+                if el.get(Tokenizer.IDTAG) is not None:
+                    el.set(Tokenizer.IDTAG, '%s-%d' % (el.get(Tokenizer.IDTAG), i))
+            for j, abbr in enumerate(list(block.iter('%sabbr' % tei_ns))):
+                if j % 10 == 0 and abbr.getparent().tag != '%schoice' % tei_ns:
+                    choice = etree.Element('%schoice' % tei_ns)
+                    choice.tail = abbr.tail
+                    abbr.tail = None
+                    abbr.addprevious(choice)
+                    choice.append(abbr)
+                    etree.SubElement(choice, '%sexpan' % tei_ns).text = (abbr.text or '') + 'ա'
+            body.append(block)
+    return doc
+
+
+def best_time(fn):
+    """Return the shortest time that fn takes, over enough runs to be sure of it.
+    The objects that exist beforehand (e.g. the documents of the other sizes) are
+    kept out of the way of the garbage collector, so that they don't count."""
+    gc.collect()
+    gc.freeze()
+    try:
+        start = time.perf_counter()
+        fn()
+        best = time.perf_counter() - start
+        for _ in range(min(4, int(MIN_TIME / max(best, 1e-6)))):
+            start = time.perf_counter()
+            fn()
+            best = min(best, time.perf_counter() - start)
+    finally:
+        gc.unfreeze()
+    return best
+
+
+@unittest.skipUnless(BENCHMARK, "set TPEN2TEI_BENCHMARK to run the benchmarks")
+class Benchmark(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        settings = config()
+        cls.source = etree.parse(settings['testfiles']['xmlreal'])
+        scales = BENCHMARK.split(',') if ',' in BENCHMARK else ['1', '10', '100']
+        cls.scales = [int(s) for s in scales]
+        cls.docs = {scale: synthetic_witness(cls.source, scale) for scale in cls.scales}
+        cls.tmpdir = tempfile.TemporaryDirectory()
+        cls.files = {}
+        for scale, doc in cls.docs.items():
+            cls.files[scale] = os.path.join(cls.tmpdir.name, 'witness-%d.xml' % scale)
+            doc.write(cls.files[scale], encoding='utf-8', xml_declaration=True)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.tmpdir.cleanup()
+
+    def check_scaling(self, name, run, scales=None):
+        """Time run(scale, doc) at each size (or at each of the given ones), and
+        check that the time grows no faster than we allow. Returns the times."""
+        if scales is None:
+            scales = self.scales
+        times = []
+        for scale in scales:
+            doc = self.docs[scale]
+            times.append(best_time(lambda: run(scale, doc)))
+        print('\n%-14s %s' % (name, '  '.join('%dx: %.3fs' % st for st in zip(scales, times))))
+        for (s1, t1), (s2, t2) in zip(zip(scales, times), zip(scales[1:], times[1:])):
+            exponent = math.log(t2 / t1) / math.log(s2 / s1)
+            self.assertLessEqual(exponent, MAX_EXPONENT,
+                                 "%s: %dx took %.3fs, but %dx took %.3fs" % (name, s1, t1, s2, t2))
+        return times
+
+    def test_final_layer(self):
+        self.check_scaling('final layer', lambda scale, doc: Tokenizer().from_etree(doc))
+
+    def test_first_layer(self):
+        self.check_scaling('first layer', lambda scale, doc: Tokenizer(first_layer=True).from_etree(doc))
+
+    def test_both_layers(self):
+        self.check_scaling('both layers', lambda scale, doc: Tokenizer().from_etree(doc, both_layers=True))
+
+    def test_milestone(self):
+        # The section of the last copy, so that all the text before it is gone through
+        self.check_scaling('milestone',
+                           lambda scale, doc: Tokenizer(milestone='407.%d' % (scale - 1)).from_etree(doc))
+
+    def test_milestone_first(self):
+        # The section of the first copy, which should take about as long whatever
+        # comes after it. Finding the blocks and the milestones means going through
+        # the whole document, though, so the time that lxml takes to do that is
+        # left out.
+        ns = {'t': 'http://www.tei-c.org/ns/1.0'}
+        thetext = etree.XPath('/descendant::t:text[1]', namespaces=ns)
+        blocks = etree.XPath(Tokenizer.block_xpath, namespaces=ns)
+
+        def scan(doc):
+            blocks(thetext(doc)[0])
+            milestone_index(doc.getroot())
+
+        times = []
+        for scale in self.scales:
+            doc = self.docs[scale]
+            times.append((best_time(lambda: Tokenizer(milestone='407.0').from_etree(doc)),
+                          best_time(lambda: scan(doc))))
+        print('\n%-14s %s' % ('first section', '  '.join('%dx: %.3fs (scans %.3fs)' % (scale, first, scans)
+                                                          for scale, (first, scans) in zip(self.scales, times))))
+        rest = [max(first - scans, 0) for first, scans in times]
+        for scale, time_taken in zip(self.scales[1:], rest[1:]):
+            self.assertLessEqual(time_taken, MAX_FLAT * rest[0],
+                                 "first section: %dx took %.3fs, but %dx took %.3fs besides finding the blocks"
+                                 % (self.scales[0], rest[0], scale, time_taken))
+
+    def test_sections(self):
+        self.check_scaling('sections', lambda scale, doc: Tokenizer().sections_from_etree(doc))
+
+    def test_fields(self):
+        self.check_scaling('fields', lambda scale, doc: Tokenizer(fields=['t', 'n']).from_etree(doc))
+
+    def test_punctuation(self):
+        self.check_scaling('punctuation',
+                           lambda scale, doc: Tokenizer(punctuation=['.', ',', '։', ':']).from_etree(doc))
+
+    def test_normaliser(self):
+        normaliser = Normaliser(lowercase=True, replace={'եւ': 'և'}, remove=r'\W')
+        self.check_scaling('normaliser', lambda scale, doc: Tokenizer(normalisation=normaliser).from_etree(doc))
+
+    def test_stream(self):
+        self.check_scaling('stream', lambda scale, doc: list(Tokenizer().stream_file(self.files[scale])['tokens']))
+
+    def test_block_cache(self):
+        # Time the second run, when all the blocks are in the cache.
+        caches = {scale: BlockCache() for scale in self.scales}
+        for scale in self.scales:
+            Tokenizer(block_cache=caches[scale]).from_etree(self.docs[scale])
+        self.check_scaling('block cache',
+                           lambda scale, doc: Tokenizer(block_cache=caches[scale]).from_etree(doc))
+
+    def test_parallel_blocks(self):
+        # The source has a single block, which is tokenized in this process, so
+        # only the sizes with more than one are compared.
+        scales = [scale for scale in self.scales if scale > 1]
+        times = self.check_scaling('parallel', lambda scale, doc: Tokenizer(jobs=2).from_etree(doc), scales=scales)
+        # How much faster than in a single process, which depends on how many CPUs
+        # there are to run the processes on.
+        serial = [best_time(lambda: Tokenizer().from_etree(self.docs[scale])) for scale in scales]
+        print('%-14s %s  (%d CPUs)' % ('speedup', '  '.join('%dx: %.2f' % (scale, t1 / t2) for scale, t1, t2
+                                                             in zip(scales, serial, times)), os.cpu_count()))
+
+    def test_witness_cache(self):
+        # Time the second run, when the witness is in the cache.
+        with tempfile.TemporaryDirectory() as tmp:
+            caches = {scale: WitnessCache(os.path.join(tmp, str(scale))) for scale in self.scales}
+            for scale in self.scales:
+                Tokenizer(witness_cache=caches[scale]).from_file(self.files[scale])
+            self.check_scaling('witness cache',
+                               lambda scale, doc: Tokenizer(witness_cache=caches[scale]).from_file(self.files[scale]))
+
+    def test_synthetic_witness(self):
+        """Test that the synthetic witnesses have as many tokens and milestones as
+        they should."""
+        tokens = len(Tokenizer().from_etree(self.source)['tokens'])
+        milestones = len(milestone_index(self.source.getroot()))
+        for scale in self.scales:
+            doc = self.docs[scale]
+            self.assertEqual(milestones * scale, len(milestone_index(doc.getroot())))
+            self.assertEqual(tokens * scale, len(Tokenizer().from_etree(doc)['tokens']))
@@ -1,10 +1,14 @@
 import unittest
 
-from tpen2tei.parse import from_sc
+from tpen2tei.parse import from_sc, from_sc_stream, convert_files, _CanvasReader
 from contextlib import redirect_stderr
 from config import config as config
 import helpers
 import io
+import json
+import os
+import tempfile
+from lxml import etree
 
 __author__ = 'tla'
 
@@ -423,4 +427,87 @@ class Test(unittest.TestCase):
         for tag in d_root.iter(self.ns('pb')):
             visited = True
             self.assertEquals('interesting', tag.get('ana'))
-        self.assertTrue(visited)
\ No newline at end of file
+        self.assertTrue(visited)
+
+    def test_stream(self):
+        """Check that reading the JSON from a file a canvas at a time gives the same
+        document as reading it all in at once, whether the file is text or binary."""
+        for key in ['json', 'm3519']:
+            expected = etree.tostring(from_sc(helpers.load_JSON_file(self.testfiles[key]),
+                                              members=helpers.test_members(),
+                                              special_chars=self.glyphs,
+                                              text_filter=helpers.tpen_filter))
+            with open(self.testfiles[key], encoding='utf-8') as fh:
+                streamed = from_sc_stream(fh, members=helpers.test_members(),
+                                          special_chars=self.glyphs,
+                                          text_filter=helpers.tpen_filter)
+            self.assertEqual(expected, etree.tostring(streamed))
+            with open(self.testfiles[key], 'rb') as fh:
+                streamed = from_sc_stream(fh, members=helpers.test_members(),
+                                          special_chars=self.glyphs,
+                                          text_filter=helpers.tpen_filter)
+            self.assertEqual(expected, etree.tostring(streamed))
+
+    def test_stream_chunks(self):
+        """Check that the canvases are read correctly however the file is split into
+        chunks, even when a value (a number in particular) runs across the split."""
+        with open(self.testfiles['m3519'], encoding='utf-8') as fh:
+            real = fh.read()
+        texts = {'{"a": 12345, "sequences": [{"canvases": [1, 2.5e10, {"x": [1,2]}]}], "z": 999999}':
+                 [1, 2, 3, 4, 5, 16],
+                 '{"sequences": [{"canvases": [-1.5E-3, 12e2, true, null, "a\\"b"]}]}': [1, 2, 3, 7],
+                 real: [7, 64, 1000]}
+        chunk = _CanvasReader.CHUNK
+        try:
+            for text, sizes in texts.items():
+                toplevel = json.loads(text)
+                canvases = toplevel.pop('sequences')[0]['canvases']
+                for size in sizes:
+                    _CanvasReader.CHUNK = size
+                    reader = _CanvasReader(io.StringIO(text))
+                    self.assertEqual(canvases, list(reader.canvases()))
+                    self.assertEqual(toplevel, reader.toplevel)
+        finally:
+            _CanvasReader.CHUNK = chunk
+
+    def test_fixups(self):
+        """Check that the user's own fixups are run on the elements they are meant for."""
+        seen = []
+
+        def fix_lb(el):
+            seen.append(el.tag)
+            el.set('rend', 'fixed')
+
+        d_json = helpers.load_JSON_file(self.testfiles['m3519'])
+        d_root = from_sc(d_json,
+                         special_chars=self.glyphs,
+                         text_filter=helpers.tpen_filter,
+                         fixups={'lb': fix_lb})
+        lbs = list(d_root.iter(self.ns('lb')))
+        self.assertTrue(len(lbs) > 0)
+        self.assertEqual(['lb'] * len(lbs), seen)
+        for lb in lbs:
+            self.assertEqual('fixed', lb.get('rend'))
+
+    def test_convert_files(self):
+        """Check that a batch of files is converted, in parallel or not, and that the
+        files that are already up to date are left alone."""
+        infiles = [self.testfiles['json'], self.testfiles['m3519'], self.testfiles['broken']]
+        md = {'short_error': True}
+        with tempfile.TemporaryDirectory() as outdir:
+            results = list(convert_files(infiles, outdir, metadata=md, jobs=2))
+            self.assertEqual(infiles, [r['infile'] for r in results])
+            self.assertEqual(['converted', 'converted', 'failed'], [r['status'] for r in results])
+            self.assertRegex(results[2]['messages'], 'Parsing error in the JSON')
+            self.assertEqual(['M1731.xml', 'M3519.xml'], sorted(os.listdir(outdir)))
+            expected = etree.tostring(from_sc(helpers.load_JSON_file(infiles[0]), metadata={'short_error': True}),
+                                      encoding='utf-8', pretty_print=True, xml_declaration=True)
+            with open(results[0]['outfile'], 'rb') as fh:
+                self.assertEqual(expected, fh.read())
+            # The metadata that was passed in is left as it was.
+            self.assertEqual({'short_error': True}, md)
+
+            results = list(convert_files(infiles, outdir, metadata=md))
+            self.assertEqual(['skipped', 'skipped', 'failed'], [r['status'] for r in results])
+            results = list(convert_files(infiles[:2], outdir, metadata=md, force=True))
+            self.assertEqual(['converted', 'converted'], [r['status'] for r in results])
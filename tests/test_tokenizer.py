@@ -3,13 +3,22 @@ __author__ = 'tla'
 import unittest
 
 from tpen2tei.parse import from_sc
-from tpen2tei.wordtokenize import Tokenizer, tokens_to_string
-from lxml.etree import fromstring, XMLSyntaxError
+from tpen2tei.wordtokenize import Tokenizer, Normaliser, BatchNormaliser, BlockCache, WitnessCache, milestone_index, \
+    tokens_to_string, write_witnesses
+from lxml.etree import fromstring, parse, SubElement, XMLParser, XMLSyntaxError
 from json.decoder import JSONDecodeError
 
 from config import config as config
+import functools
 import helpers
+import io
+import json
+import os
+import pickle
 import re
+import sys
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
 
 class Test (unittest.TestCase):
 
@@ -169,6 +178,21 @@ class Test (unittest.TestCase):
         else:
             self.assertTrue(False, "Did not find the testing token")
 
+    def test_both_layers(self):
+        """Test that reading both layers at once gives the same result as reading
+        each of them separately."""
+        final, first = Tokenizer().from_etree(self.testdoc, both_layers=True)
+        self.assertEqual(final, Tokenizer().from_etree(self.testdoc))
+        self.assertEqual(first, Tokenizer(first_layer=True).from_etree(self.testdoc))
+        self.assertNotEqual(final['tokens'], first['tokens'])
+
+        tok = Tokenizer(milestone='407', normalisation=helpers.normalise)
+        final, first = tok.from_file(self.testfiles['xmlreal'], both_layers=True)
+        self.assertEqual(final, Tokenizer(milestone='407', normalisation=helpers.normalise)
+                         .from_file(self.testfiles['xmlreal']))
+        self.assertEqual(first, Tokenizer(milestone='407', first_layer=True, normalisation=helpers.normalise)
+                         .from_file(self.testfiles['xmlreal']))
+
     def test_token_context(self):
         """Test that each token has a context, and each 'lit' string is parseable."""
         tok = Tokenizer(normalisation=helpers.normalise)
@@ -216,6 +240,30 @@ class Test (unittest.TestCase):
         except Exception as e:
             self.assertIsInstance(e, JSONDecodeError)
 
+    def test_normaliser(self):
+        """Test that a declarative or a batch normalisation does what the equivalent
+        normalisation function would do."""
+        def normalise(token):
+            if token['n'] == token['t']:
+                token['n'] = re.sub(r'\W', '', token['n'].lower().replace('եւ', 'և').replace('աւ', 'օ'))
+            return token
+
+        normaliser = Normaliser(lowercase=True, replace={'եւ': 'և', 'աւ': 'օ'}, remove=r'\W', keep_given=True)
+        self.assertEqual(normaliser.normalise('Աւագ, եւ'), 'օագև')
+        self.assertEqual(normaliser.normalise_all(['Աւագ,', '', 'Եւ']), ['օագ', '', 'և'])
+        expected = Tokenizer(normalisation=normalise).from_etree(self.testdoc)
+        self.assertEqual(Tokenizer(normalisation=normaliser).from_etree(self.testdoc), expected)
+        batch = BatchNormaliser(lambda tokens: [normalise(t) for t in tokens])
+        self.assertEqual(Tokenizer(normalisation=batch).from_etree(self.testdoc), expected)
+
+        column = BatchNormaliser(lambda strings: [s.upper() for s in strings], column='t')
+        tokens = Tokenizer(milestone='401', normalisation=column).from_etree(self.testdoc)['tokens']
+        self.assertEqual(tokens[0]['t'], 'ԻՍԿ')
+        with open(self.testfiles['xmlreal'], 'rb') as fh:
+            streamed = Tokenizer(normalisation=normaliser).stream_fh(fh)
+            self.assertEqual(list(streamed['tokens']),
+                             Tokenizer(normalisation=normalise).from_file(self.testfiles['xmlreal'])['tokens'])
+
     def test_location(self):
         tokens = Tokenizer(milestone='407').from_etree(self.testdoc)['tokens']
         self.assertEqual(tokens[0]['page'], {'n': '75v'})
@@ -223,6 +271,93 @@ class Test (unittest.TestCase):
         self.assertEqual(tokens[10]['line'], {'xml:id': 'l101276840', 'facs': '#z101276840', 'n': '13'})  # line broken
         self.assertEqual(tokens[22]['line'], {'xml:id': 'l101276843', 'facs': '#z101276843', 'n': '16'})    # beginning of line
 
+    def test_location_section(self):
+        """Test that the tokens of a section that begins further on in the text have
+        the locations they have when the whole text is tokenized, whatever markers
+        and containers come before the section."""
+        doc = fromstring('<TEI xmlns="http://www.tei-c.org/ns/1.0"><teiHeader><pb n="0"/></teiHeader>'
+                         '<text><body><div n="1"><pb n="1"/><p>ա <lb n="1"/>բ</p><lb n="2"/>'
+                         '<div n="2"><cb n="a"/><p>գ <milestone n="1"/>դ <lb n="3"/>ե</p></div>'
+                         '<pb n="2"/><p>զ <milestone n="2"/>է</p></div><p>ը <milestone n="3"/>թ</p>'
+                         '</body></text></TEI>')
+        fields = ['t', 'section', 'page', 'column', 'line']
+        whole = Tokenizer(fields=fields).from_element(doc)['tokens']
+        self.assertEqual([t['t'] for t in whole], ['ա', 'բ', 'գ', 'դ', 'ե', 'զ', 'է', 'ը', 'թ'])
+        for n, start, end in [('1', 3, 6), ('2', 6, 8), ('3', 8, 9)]:
+            self.assertEqual(Tokenizer(milestone=n, fields=fields).from_element(doc)['tokens'], whole[start:end])
+            self.assertEqual(Tokenizer(fields=fields).sections_from_element(doc, [n])[n]['tokens'],
+                             whole[start:end])
+        self.assertEqual(whole[3]['page'], {'n': '1'})
+        self.assertEqual(whole[3]['column'], {'n': 'a'})
+        self.assertEqual(whole[3]['line'], {'n': '2'})
+        self.assertEqual(whole[3]['section'], {'n': '2'})
+        self.assertEqual(whole[6]['page'], {'n': '2'})
+        self.assertNotIn('section', whole[8])
+
+    def test_location_shared(self):
+        """Test that the tokens in the same place share their location records, that
+        these survive pickling and JSON serialization, and that a record can be replaced
+        though not changed in place."""
+        tokens = Tokenizer(milestone='407').from_etree(self.testdoc)['tokens']
+        self.assertIs(tokens[0]['page'], tokens[1]['page'])
+        self.assertIs(tokens[0]['line'], tokens[1]['line'])
+        with self.assertRaises(TypeError):
+            tokens[0]['line']['n'] = '99'
+        copies = pickle.loads(pickle.dumps(tokens))
+        self.assertEqual(copies, tokens)
+        self.assertIs(copies[0]['page'], copies[1]['page'])
+        self.assertEqual(json.loads(json.dumps(tokens)), copies)
+        line = tokens[1]['line']
+        tokens[0]['line'] = dict(line, n='99')
+        self.assertEqual('99', tokens[0]['line']['n'])
+        self.assertIsNot(tokens[0]['line'], line)
+        self.assertNotEqual('99', tokens[1]['line']['n'])
+
+    def test_location_normalisation(self):
+        """Test that a normalisation function can change the location fields of a token,
+        without changing those of the other tokens in the same place."""
+        seen = []
+
+        def renumber(token):
+            if not len(seen):
+                token['line']['n'] = '99'
+            seen.append(token)
+            return token
+
+        def renumber_all(tokens):
+            return [renumber(t) for t in tokens]
+
+        plain = Tokenizer(milestone='407').from_etree(self.testdoc)['tokens']
+        for normalisation in (renumber, BatchNormaliser(renumber_all)):
+            del seen[:]
+            tokens = Tokenizer(milestone='407', normalisation=normalisation).from_etree(self.testdoc)['tokens']
+            self.assertEqual('99', tokens[0]['line']['n'])
+            self.assertEqual(plain[1:], tokens[1:])
+            # The tokens that were left alone still share their records.
+            self.assertIs(tokens[1]['line'], tokens[2]['line'])
+
+    def test_fields(self):
+        """Test that only the token fields that are asked for are produced, and that
+        they are the same as they would otherwise be."""
+        flags = ('join_prior', 'join_next', 'continue')
+        full = Tokenizer(punctuation=[',', '.', '։']).from_etree(self.testdoc)['tokens']
+        for fields in (['t'], ['t', 'n'], ['n', 'context'], ['t', 'lit', 'line']):
+            tokens = Tokenizer(punctuation=[',', '.', '։'], fields=fields).from_etree(self.testdoc)['tokens']
+            self.assertEqual(tokens, [{k: v for k, v in t.items() if k in fields or k in flags} for t in full])
+        with self.assertRaises(ValueError):
+            Tokenizer(fields=['t', 'x'])
+        # A normalisation function sees only the fields that were asked for, and 't' and 'n'.
+        seen = set()
+
+        def note_fields(token):
+            seen.update(token.keys())
+            return token
+
+        for normalisation in (note_fields, BatchNormaliser(lambda tokens: [note_fields(t) for t in tokens])):
+            seen.clear()
+            Tokenizer(fields=['t', 'line'], normalisation=normalisation).from_etree(self.testdoc)
+            self.assertEqual({'t', 'n', 'line'}, seen - set(flags))
+
     # def test_del_word_boundary(self):
     #     """Test that a strategically placed del doesn't cause erroneous joining of words.
     #     TODO add testing data"""
@@ -261,6 +396,200 @@ class Test (unittest.TestCase):
         self.assertEqual(tokens407[0]['t'], 'Դարձլ')
         self.assertEqual(tokens407[-1]['t'], 'ուռհայ։')
 
+    def test_milestone_sections(self):
+        """Test that tokenizing several milestone sections at once gives the same
+        result as tokenizing each of them separately."""
+        index = milestone_index(self.testdoc.getroot())
+        self.assertEqual(list(index.keys()), ['401', '407', '408'])
+        sections = Tokenizer().sections_from_etree(self.testdoc)
+        self.assertEqual(list(sections.keys()), ['401', '407', '408'])
+        self.assertEqual(len(sections['401']['tokens']), 132)
+        self.assertEqual(len(sections['407']['tokens']), 76)
+        for n, result in sections.items():
+            self.assertEqual(result, Tokenizer(milestone=n).from_etree(self.testdoc))
+
+        tok = Tokenizer(first_layer=True, normalisation=helpers.normalise)
+        sections = tok.sections_from_etree(self.testdoc, milestones=['407', '999'])
+        self.assertEqual(sections['407'],
+                         Tokenizer(milestone='407', first_layer=True,
+                                   normalisation=helpers.normalise).from_etree(self.testdoc))
+        self.assertEqual(sections['999']['tokens'], [])
+
+    def test_reentrant(self):
+        """Test that a single tokenizer can be used for several documents at once,
+        and that it can be pickled after use."""
+        tok = Tokenizer(milestone='401', normalisation=helpers.normalise)
+        docs = [self.testdoc, self.testdoc_noglyphs, self.doc3519] * 4
+        expected = [Tokenizer(milestone='401', normalisation=helpers.normalise).from_etree(d)
+                    for d in docs]
+        with ThreadPoolExecutor(max_workers=4) as pool:
+            results = list(pool.map(tok.from_etree, docs))
+        self.assertEqual(results, expected)
+
+        copy = pickle.loads(pickle.dumps(tok))
+        self.assertEqual(copy.from_etree(self.testdoc), expected[0])
+
+    def test_write_witnesses(self):
+        """Test that witnesses tokenized in parallel are written out in order."""
+        files = [self.testfiles['xmlreal'], self.testfiles['v913'], self.testfiles['xmlreal']]
+        tok = Tokenizer(milestone='401', first_layer=True)
+        expected = json.dumps({'witnesses': [tok.from_file(f) for f in files]}, ensure_ascii=False)
+        for jobs in [1, 3]:
+            with io.BytesIO() as out:
+                write_witnesses(tok, files, out, jobs=jobs)
+                self.assertEqual(out.getvalue().decode('utf-8'), expected)
+
+    def test_parallel_blocks(self):
+        """Test that tokenizing the blocks of a document in parallel gives the same
+        result as tokenizing them one after another."""
+        doc = parse(self.testfiles['matenadaran_xml'])
+        for milestone in [None, '401', '407']:
+            expected = Tokenizer(milestone=milestone).from_etree(doc)
+            self.assertEqual(Tokenizer(milestone=milestone, jobs=4).from_etree(doc), expected)
+        for doc in [self.doc3519, self.testdoc]:
+            tok = Tokenizer(punctuation=[',', '.'], normalisation=helpers.normalise)
+            expected = tok.from_etree(doc, both_layers=True)
+            tok = Tokenizer(punctuation=[',', '.'], normalisation=helpers.normalise, jobs=3)
+            self.assertEqual(tok.from_etree(doc, both_layers=True), expected)
+            self.assertEqual(Tokenizer(jobs=3).sections_from_etree(doc), Tokenizer().sections_from_etree(doc))
+
+        # Each process sees only its own blocks, which have to be given the paths
+        # and the locations that they have in the whole document.
+        xml = ('<!DOCTYPE TEI [<!ENTITY e "E">]>'
+               '<TEI xmlns="http://www.tei-c.org/ns/1.0" xmlns:xi="http://www.w3.org/2001/XInclude">'
+               '<text><body><div n="1"><pb n="1"/><p>ա <lb n="1"/>բ</p><lb n="2"/>'
+               '<div n="2"><cb n="a"/><ab>գ <p>դ <lb n="3"/>ե</p> զ</ab></div>'
+               '<pb n="2"/><p>է %s<milestone n="1"/>ը</p></div><p>թ</p></body></text></TEI>')
+        parser = XMLParser(resolve_entities=False)
+        for entity, fields in [('', None), ('&e; ', ['t', 'n', 'lit', 'section', 'paragraph', 'page', 'line'])]:
+            doc = fromstring(xml % entity, parser)
+            for milestone in [None, '1']:
+                expected = Tokenizer(milestone=milestone, fields=fields).from_element(doc)
+                self.assertEqual(Tokenizer(milestone=milestone, fields=fields, jobs=3).from_element(doc), expected)
+
+    def test_block_cache(self):
+        """Test that a tokenizer with a block cache tokenizes only the blocks that
+        have changed, and gives the same result as one without."""
+        doc = parse(self.testfiles['matenadaran_xml'])
+        cache = BlockCache()
+        tok = Tokenizer(normalisation=helpers.normalise, block_cache=cache)
+        expected = Tokenizer(normalisation=helpers.normalise).from_etree(doc)
+        self.assertEqual(tok.from_etree(doc), expected)
+        blocks = len(cache)
+        self.assertEqual((0, blocks), (cache.hits, cache.misses))
+        self.assertEqual(tok.from_etree(doc), expected)
+        self.assertEqual((blocks, blocks), (cache.hits, cache.misses))
+
+        # Change the text of one block, and the number of a line in another.
+        body = doc.getroot().find('.//{%s}body' % self.tei_ns)
+        blocks = body.findall('.//{%s}p' % self.tei_ns)
+        blocks[1].text = 'ա բ գ ' + (blocks[1].text or '')
+        line = blocks[3].find('.//{%s}lb' % self.tei_ns)
+        line.set('n', 'x' + line.get('n', ''))
+        expected = Tokenizer(normalisation=helpers.normalise).from_etree(doc)
+        hits, misses = cache.hits, cache.misses
+        self.assertEqual(tok.from_etree(doc), expected)
+        self.assertGreaterEqual(cache.misses - misses, 2)
+        self.assertGreater(cache.hits - hits, 0)
+
+        # The cache can be saved for another time.
+        with tempfile.TemporaryDirectory() as tmp:
+            filename = os.path.join(tmp, 'blocks.cache')
+            cache.save(filename)
+            loaded = BlockCache.load(filename)
+        self.assertEqual(len(loaded), len(cache))
+        tok = Tokenizer(normalisation=helpers.normalise, block_cache=loaded)
+        self.assertEqual(tok.from_etree(doc), expected)
+        self.assertEqual(0, loaded.misses)
+
+        small = BlockCache(max_blocks=2)
+        self.assertEqual(Tokenizer(block_cache=small).from_etree(doc), Tokenizer().from_etree(doc))
+        self.assertEqual(2, len(small))
+
+    def test_witness_cache(self):
+        """Test that the results for whole documents are kept on disk, and found
+        again only for the same document and options."""
+        filename = self.testfiles['xmlreal']
+        normalise = functools.partial(helpers.normalise)
+        normalise.cache_key = 'helpers.normalise'
+        with tempfile.TemporaryDirectory() as tmp:
+            cache = WitnessCache(tmp)
+            tok = Tokenizer(milestone='401', normalisation=normalise, witness_cache=cache)
+            expected = Tokenizer(milestone='401', normalisation=normalise).from_file(filename)
+            tokenized = tok.from_file(filename)
+            cached = tok.from_file(filename)
+            self.assertEqual(tokenized, expected)
+            self.assertEqual(cached, expected)
+            self.assertEqual((1, 1), (cache.hits, cache.misses))
+            # The location fields that come from the cache are shared, read-only
+            # records, just like the ones that come from the tokenizer.
+            for result in (tokenized, cached):
+                first, second = result['tokens'][:2]
+                self.assertIs(type(first['line']), type(expected['tokens'][0]['line']))
+                self.assertIs(first['line'], second['line'])
+                with self.assertRaises(TypeError):
+                    first['line']['n'] = 'x'
+
+            # A different option, or a different normalisation, is a different result.
+            tok = Tokenizer(milestone='401', witness_cache=cache)
+            self.assertEqual(tok.from_file(filename), Tokenizer(milestone='401').from_file(filename))
+            tok = Tokenizer(milestone='401', normalisation=Normaliser(lowercase=True), witness_cache=cache)
+            tok.from_file(filename)
+            self.assertEqual((1, 3), (cache.hits, cache.misses))
+
+            # Parsed documents are cached by their contents too.
+            tok = Tokenizer(normalisation=normalise, witness_cache=cache)
+            expected = Tokenizer(normalisation=normalise).from_etree(self.testdoc, both_layers=True)
+            self.assertEqual(tok.from_etree(self.testdoc, both_layers=True), expected)
+            self.assertEqual(tok.from_etree(self.testdoc, both_layers=True), expected)
+            self.assertEqual(tok.from_etree(self.testdoc_noglyphs),
+                             Tokenizer(normalisation=normalise).from_etree(self.testdoc_noglyphs))
+            stats = cache.stats()
+            self.assertEqual((2, 5, 5), (stats['hits'], stats['misses'], stats['entries']))
+
+            # The results that were used last are the ones that are kept.
+            tok.from_etree(self.testdoc, both_layers=True)
+            cache.evict(stats['bytes'] // 2)
+            self.assertLess(cache.stats()['entries'], 5)
+            tok.from_etree(self.testdoc, both_layers=True)
+            self.assertEqual(4, cache.hits)
+            cache.clear()
+            self.assertEqual(0, cache.size())
+
+    def test_witness_cache_identity(self):
+        """Test that normalisations are told apart by the witness cache by their
+        settings or their cache_key, and that one with neither is not cached."""
+        def replace(token, old, new):
+            token['n'] = token['n'].replace(old, new)
+            return token
+
+        def upper(values):
+            return [v.upper() for v in values]
+        upper.cache_key = 1
+
+        with tempfile.TemporaryDirectory() as tmp:
+            cache = WitnessCache(tmp)
+            for new in ('X', 'Y', 'X'):
+                normalisation = functools.partial(replace, old='ա', new=new)
+                normalisation.cache_key = new
+                tokens = Tokenizer(normalisation=normalisation, witness_cache=cache).from_etree(self.testdoc)
+                self.assertEqual(tokens, Tokenizer(normalisation=normalisation).from_etree(self.testdoc))
+            self.assertEqual((1, 2), (cache.hits, cache.misses))
+
+            for normalisation in (Normaliser(replace={'ա': 'X'}), Normaliser(replace={'ա': 'Y'}),
+                                  BatchNormaliser(upper, column='n')):
+                tok = Tokenizer(normalisation=normalisation, witness_cache=cache)
+                self.assertEqual(tok.from_etree(self.testdoc), tok.from_etree(self.testdoc))
+            self.assertEqual((4, 5), (cache.hits, cache.misses))
+
+            # Without a key, the results are not looked for in the cache, nor kept.
+            for normalisation in (functools.partial(replace, old='ա', new='X'), lambda t: t,
+                                  BatchNormaliser(lambda values: values, column='n')):
+                tok = Tokenizer(normalisation=normalisation, witness_cache=cache)
+                tok.from_etree(self.testdoc)
+                tok.from_etree(self.testdoc)
+            self.assertEqual((4, 5, 5), (cache.hits, cache.misses, cache.stats()['entries']))
+
     # def test_arbitrary_element(self):
     #     """Test that arbitrary tags (e.g. <abbr>) are passed into 'lit' correctly."""
     #     pass
@@ -284,6 +613,21 @@ class Test (unittest.TestCase):
         self.assertEqual(tokens[0], first_word)
         self.assertEqual(tokens[-1], last_word)
 
+    def test_stream(self):
+        """Test that streaming a file gives the same result as parsing it."""
+        filename = self.testfiles['xmlreal']
+        for milestone in [None, '401', '412']:
+            expected = Tokenizer(milestone=milestone, id_xpath='//t:msDesc/@xml:id').from_file(filename)
+            result = Tokenizer(milestone=milestone, id_xpath='//t:msDesc/@xml:id').stream_file(filename)
+            self.assertEqual(result['id'], expected['id'])
+            self.assertEqual(list(result['tokens']), expected['tokens'])
+
+        filename = self.testfiles['v913']
+        expected = Tokenizer(first_layer=True).from_file(filename)
+        with open(filename, 'rb') as fh:
+            result = Tokenizer(first_layer=True).stream_fh(fh)
+            self.assertEqual(list(result['tokens']), expected['tokens'])
+
     def test_tagend(self):
         filename = self.testfiles['xmlreal']
         tokens = Tokenizer(milestone="401").from_file(filename)['tokens']
@@ -292,6 +636,17 @@ class Test (unittest.TestCase):
         for t in tokens:
             self.assertNotEqual(t['t'], "")
 
+    def test_nested_lit(self):
+        """Test that the literal form of nested single-word elements is what lxml
+        would serialize, with the TEI namespace left out."""
+        doc = fromstring('<TEI xmlns="http://www.tei-c.org/ns/1.0"><text><body><p>'
+                         '<hi rend="a&amp;b&#10;"><abbr xml:id="x1">ա&lt;բ<!--c--></abbr><lb n="2"/></hi> '
+                         'գ<g ref="#q"/>դ</p></body></text></TEI>')
+        tokens = Tokenizer().from_element(doc)['tokens']
+        self.assertEqual(tokens[0]['lit'], '<hi rend="a&amp;b&#10;"><abbr xml:id="x1">ա&lt;բ<!--c--></abbr>'
+                                           '<lb n="2"/></hi>')
+        self.assertEqual(tokens[1]['lit'], 'գ<g ref="#q"/>դ')
+
     def test_del_gap_linened(self):
         filename = self.testfiles['v913']
         tokens = Tokenizer(milestone="496").from_file(filename)['tokens']
@@ -304,6 +659,61 @@ class Test (unittest.TestCase):
         self.assertEqual("պտրզմին", tokens[5]['t'])
         self.assertEqual("պատերազմին", tokens[5]['n'])
 
+    def test_nested_choice(self):
+        doc = fromstring('<TEI xmlns="http://www.tei-c.org/ns/1.0"><text><body><p>ա <choice><sic>բ'
+                         '<choice><abbr>գ</abbr><expan>գդ</expan></choice></sic><corr>բգդե</corr>'
+                         '</choice> զ</p></body></text></TEI>')
+        tokens = Tokenizer().from_element(doc)['tokens']
+        self.assertEqual([t['t'] for t in tokens], ['ա', 'բգ', 'զ'])
+        self.assertEqual(tokens[1]['n'], 'բգդե')
+        self.assertTrue(tokens[1]['lit'].startswith('<choice><sic>'))
+
+    def test_deep_nesting(self):
+        """Test that markup nested far deeper than the recursion limit is no problem."""
+        depth = sys.getrecursionlimit() * 3
+        doc = fromstring('<TEI xmlns="http://www.tei-c.org/ns/1.0"><text><body><p/></body></text></TEI>')
+        el = doc[0][0][0]
+        for i in range(depth):
+            el = SubElement(el, '{%s}hi' % self.tei_ns)
+            el.text = 'ա%d ' % i
+            el.tail = ' բ%d' % i
+        tokens = Tokenizer().from_element(doc)['tokens']
+        self.assertEqual(2 * depth, len(tokens))
+        self.assertEqual(['ա0', 'ա1'], [t['t'] for t in tokens[:2]])
+        self.assertEqual(['բ1', 'բ0'], [t['t'] for t in tokens[-2:]])
+        self.assertEqual('text/body/p' + '/hi' * (depth - 1), tokens[depth - 1]['context'])
+        self.assertEqual('text/body/p', tokens[-1]['context'])
+
+        # A word that runs on through every level is joined into one token.
+        doc = fromstring('<TEI xmlns="http://www.tei-c.org/ns/1.0"><text><body><p>ա</p></body></text></TEI>')
+        el = doc[0][0][0]
+        for i in range(depth):
+            el = SubElement(el, '{%s}hi' % self.tei_ns)
+            el.text = 'բ'
+        el.tail = ' գ'
+        tokens = Tokenizer(fields=['t', 'n']).from_element(doc)['tokens']
+        self.assertEqual([{'t': 'ա' + 'բ' * depth, 'n': 'ա' + 'բ' * depth}, {'t': 'գ', 'n': 'գ'}], tokens)
+
+    def test_deep_choice(self):
+        """Test that readings and choices deeply nested inside each other are
+        tokenized as they are when they are shallow."""
+        depth = sys.getrecursionlimit() * 2
+        doc = fromstring('<TEI xmlns="http://www.tei-c.org/ns/1.0"><text><body><p>ա </p></body></text></TEI>')
+        el = doc[0][0][0]
+        for i in range(depth):
+            hi = SubElement(el, '{%s}hi' % self.tei_ns)
+            app = SubElement(hi, '{%s}app' % self.tei_ns)
+            el = SubElement(app, '{%s}rdg' % self.tei_ns)
+        choice = SubElement(el, '{%s}choice' % self.tei_ns)
+        SubElement(choice, '{%s}sic' % self.tei_ns).text = 'բգ'
+        SubElement(choice, '{%s}corr' % self.tei_ns).text = 'բդ'
+        choice.tail = ' ե'
+        tokens = Tokenizer().from_element(doc)['tokens']
+        self.assertEqual(['ա', 'բգ', 'ե'], [t['t'] for t in tokens])
+        self.assertEqual('բդ', tokens[1]['n'])
+        self.assertEqual('<choice><sic>բգ</sic><corr>բդ</corr></choice>', tokens[1]['lit'])
+        self.assertEqual('text/body/p' + '/hi/app/rdg' * depth, tokens[1]['context'])
+
     def test_custom_tokenizer(self):
         """Test that a custom tokenizer does its job."""
         mypunct = [',', '.', '։']
@@ -340,6 +750,16 @@ class Test (unittest.TestCase):
                    'սամուսատ մերձ ի քղք ուռհայ։ Իսկ ի թուակա֊նութես ազգիս հայոց ի դ՟ճ՟ և ի ը՟ ամին, զօրա֊'
         self.assertEqual(origtext, tokens_to_string(tokens))
 
+    def test_punctuation_characters(self):
+        """Test that punctuation characters are taken literally, even those that
+        mean something in a regular expression."""
+        doc = fromstring('<TEI xmlns="http://www.tei-c.org/ns/1.0"><text><body><p>'
+                         '^աբ, [գ] դ-.</p></body></text></TEI>')
+        tokens = Tokenizer(punctuation=['.', '-', ',', '^', '[', ']']).from_element(doc)['tokens']
+        self.assertEqual([t['t'] for t in tokens], ['^', 'աբ', ',', '[', 'գ', ']', 'դ', '-.'])
+        self.assertTrue(tokens[0]['join_next'])
+        self.assertTrue(tokens[2]['join_prior'])
+
     @unittest.skip("use only for debugging")
     def test_debug(self):
         filename = '/Users/tla/Projects/MatthewEdessa/transcription/tei-xml/M3071-merged.json.tei.xml'
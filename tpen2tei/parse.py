@@ -1,14 +1,23 @@
 import argparse
+import codecs
+import glob
+import io
 import json
 import os
 import re
 import sys
-from io import BytesIO
+import tempfile
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import redirect_stderr, redirect_stdout
 from lxml import etree
-from warnings import warn
+from warnings import catch_warnings, simplefilter, warn
 
 __author__ = 'tla'
 
+_TEI_NS = 'http://www.tei-c.org/ns/1.0'
+
 
 def from_sc(jsondata,
             metadata=None,
@@ -16,7 +25,8 @@ def from_sc(jsondata,
             special_chars=None,
             numeric_parser=None,
             text_filter=None,
-            postprocess=None):
+            postprocess=None,
+            fixups=None):
     """Extract the textual transcription from a JSON file, probably exported
     from T-PEN according to a Shared Canvas specification. It has a series of
     sequences (should be 1 sequence), and each sequence has a set of canvases,
@@ -46,23 +56,73 @@ def from_sc(jsondata,
 
     The optional postprocess parameter is a function that takes an etree Element
     object, which is the otherwise final parsed TEI document, and modifies it.
+
+    The optional fixups parameter is a dictionary of functions, keyed on element
+    name, e.g. {'hi': fix_hi}. Each function is passed every element of that name
+    in the transcription, and may modify it (but not remove it). This happens
+    in the same pass through the text as the fixups of from_sc's own (e.g. of
+    glyphs and numbers), after these have been done, and before the elements are
+    put into the TEI namespace; so the element names are without one.
     """
     if len(jsondata['sequences']) > 1:
         warn("Your data has more than one sequence. Check to see what's going on.", UserWarning)
-    # Merge the JSON-supplied metadata into the user-supplied. If a user has
-    # supplied a key, don't override it.
-    if 'metadata' in jsondata:
+    metadata = _merge_metadata(jsondata.get('metadata'), metadata)
+    with _BodyParser() as body:
+        facsimile, seen_members = _read_canvases(jsondata['sequences'][0]['canvases'], body, members, text_filter)
+        return _xmlify(body, facsimile, metadata, members=seen_members,
+                       special_chars=special_chars, numeric_parser=numeric_parser, postprocess=postprocess,
+                       fixups=fixups)
+
+
+def from_sc_stream(fh,
+                   metadata=None,
+                   members=None,
+                   special_chars=None,
+                   numeric_parser=None,
+                   text_filter=None,
+                   postprocess=None,
+                   fixups=None):
+    """Extract the textual transcription from an open SC-JSON file, as from_sc
+    does, but without loading the whole of the JSON into memory first. The
+    canvases are read from the file one at a time, and each is let go of once
+    its lines have been taken out, so that only the page being worked on is
+    ever held in memory. The file may be opened in text or in binary mode; in
+    the latter case it is taken to be UTF-8.
+
+    The optional parameters are the same as those of from_sc.
+    """
+    reader = _CanvasReader(fh)
+    with _BodyParser() as body:
+        facsimile, seen_members = _read_canvases(reader.canvases(), body, members, text_filter)
+        if reader.sequences > 1:
+            warn("Your data has more than one sequence. Check to see what's going on.", UserWarning)
+        metadata = _merge_metadata(reader.toplevel.get('metadata'), metadata)
+        return _xmlify(body, facsimile, metadata, members=seen_members,
+                       special_chars=special_chars, numeric_parser=numeric_parser, postprocess=postprocess,
+                       fixups=fixups)
+
+
+def _merge_metadata(jsonmetadata, metadata):
+    """Merge the JSON-supplied metadata into the user-supplied. If a user has
+    supplied a key, don't override it."""
+    if jsonmetadata is not None:
         if metadata is None:
             metadata = {}
-        for item in jsondata['metadata']:
+        for item in jsonmetadata:
             if item['label'] not in metadata and len(item['value']) > 0 and not item['value'].isspace():
                 metadata[item['label']] = item['value']
+    return metadata
 
-    pages = jsondata['sequences'][0]['canvases']
+
+def _read_canvases(pages, body, members, text_filter):
+    """Go through the canvases, i.e. the pages, of the transcription in turn, and
+    feed the XML body of the text on them to the given _BodyParser a page at a time.
+    Return the facsimile information and the project members who turned out to
+    have transcribed it."""
     facsimile = []
     notes = []
     columns = {}
-    xmlstring = ''
+    body.feed('<body>')
     nblines = set()  # Keep track of the line IDs that occur mid-word
     breaking = False
     seen_members = {}
@@ -139,7 +199,7 @@ def from_sc(jsondata,
                         notes.append((lineid, line['_tpen_note'], agent))
         # Spit out the text
         if len(thetext):
-            xmlstring += '<pb n="%s"/>\n' % pn
+            xmlstring = '<pb n="%s"/>\n' % pn
             for cn, col in enumerate(thetext):
                 if len(thetext) > 1:
                     xmlstring += '<cb n="%d"/>\n' % (cn + 1)
@@ -150,6 +210,7 @@ def from_sc(jsondata,
                     if line[0] in nblines:
                         attrstring += ' break="no"'
                     xmlstring += '<lb %s/>%s\n' % (attrstring, line[1])
+            body.feed(xmlstring)
             # Keep track of the number of columns.
             if len(thetext) in columns:
                 columns[len(thetext)].append(pn)
@@ -160,17 +221,192 @@ def from_sc(jsondata,
         attrstring = 'type="transcriptional" target="#l%s"' % n[0]
         if n[2] in seen_members:
             attrstring += ' resp="#u%s"' % n[2]
-        xmlstring += '<note %s>%s</note>\n' % (attrstring, n[1])
-    return _xmlify("<body>%s</body>" % xmlstring, facsimile, metadata, members=seen_members,
-                   special_chars=special_chars, numeric_parser=numeric_parser, postprocess=postprocess)
+        body.feed('<note %s>%s</note>\n' % (attrstring, n[1]))
+    body.feed('</body>')
+    return facsimile, seen_members
+
+
+class _BodyParser:
+    """Parses the XML of the transcription bit by bit, as the pages are read, so
+    that the tree is built up as we go along. The markup itself is kept only so
+    that the context of a parsing error can be shown; once there is more than
+    SPOOL characters of it, it goes to a temporary file rather than memory. Use
+    it in a 'with' statement, so that the file is let go of at the end."""
+
+    SPOOL = 1 << 20
+
+    def __init__(self):
+        self.parser = etree.XMLParser()
+        self.markup = tempfile.SpooledTemporaryFile(self.SPOOL, mode='w+', encoding='utf-8', newline='')
+        self.error = None
+
+    def __enter__(self):
+        return self
 
+    def __exit__(self, *exc):
+        self.markup.close()
 
-def _xmlify(txdata, facsimile, metadata, members=None, special_chars=None, numeric_parser=None, postprocess=None):
+    def feed(self, markup):
+        self.markup.write(markup)
+        # After an error the parser is of no more use, but we keep the rest of
+        # the markup for the error message.
+        if self.error is None:
+            try:
+                self.parser.feed(markup)
+            except etree.XMLSyntaxError as e:
+                self.error = e
+
+    def close(self):
+        """Return the parsed body element, or raise the first parsing error."""
+        if self.error is not None:
+            raise self.error
+        return self.parser.close()
+
+    def text(self):
+        """Return the whole of the markup that was fed to the parser."""
+        self.markup.seek(0)
+        return self.markup.read()
+
+
+class _CanvasReader:
+    """Reads an SC-JSON document from a file a piece at a time, handing out the
+    canvases of its first sequence one by one. Everything else at the top level
+    of the document is kept in the 'toplevel' dictionary, and the number of
+    sequences is counted; both are complete once the canvases have run out."""
+
+    CHUNK = 65536
+    NUMBER_CHARS = ('', '0', '1', '2', '3', '4', '5', '6', '7', '8', '9', '.', 'e', 'E', '+', '-')
+
+    def __init__(self, fh):
+        if isinstance(fh.read(0), bytes):
+            fh = codecs.getreader('utf-8')(fh)
+        self.fh = fh
+        self.buffer = ''
+        self.pos = 0
+        self.offset = 0  # The position in the file of the start of the buffer
+        self.eof = False
+        self.decoder = json.JSONDecoder()
+        self.toplevel = {}
+        self.sequences = 0
+
+    def canvases(self):
+        """Go through the document, yielding each canvas of the first sequence."""
+        found = False
+        for key in self._keys():
+            if key != 'sequences':
+                self.toplevel[key] = self._value()
+                continue
+            for _ in self._items():
+                self.sequences += 1
+                if self.sequences > 1:
+                    self._value()
+                    continue
+                for seqkey in self._keys():
+                    if seqkey == 'canvases':
+                        found = True
+                        yield from self._items(self._value)
+                    else:
+                        self._value()
+        if self._skip() != '':
+            self._fail('Extra data after the JSON document')
+        if not found:
+            raise ValueError('No canvases found in the first sequence of the JSON')
+
+    def _fill(self, wanted):
+        """Read at least as many more characters as asked for, unless the file
+        runs out first."""
+        if self.pos:
+            self.offset += self.pos
+            self.buffer = self.buffer[self.pos:]
+            self.pos = 0
+        target = len(self.buffer) + wanted
+        while not self.eof and len(self.buffer) < target:
+            chunk = self.fh.read(max(self.CHUNK, target - len(self.buffer)))
+            if chunk:
+                self.buffer += chunk
+            else:
+                self.eof = True
+
+    def _skip(self):
+        """Skip any whitespace, and return the next character (or '' at the end)."""
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in ' \t\r\n':
+                self.pos += 1
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if self.eof:
+                return ''
+            self._fill(self.CHUNK)
+
+    def _next_is(self, char):
+        """Consume the next character if it is the one given."""
+        if self._skip() == char:
+            self.pos += 1
+            return True
+        return False
+
+    def _expect(self, char):
+        if not self._next_is(char):
+            self._fail("Expecting '%s'" % char)
+
+    def _fail(self, message):
+        raise ValueError('%s in the JSON at character %d' % (message, self.offset + self.pos))
+
+    def _value(self):
+        """Decode the next complete JSON value. If it has not all been read yet,
+        read (at least) as much again as we have, and try again."""
+        self._skip()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+                # A number might carry on past the end of what we have read so far,
+                # even when the buffer ends with (say) '2.' or '12e' rather than a digit.
+                if self.eof or not (isinstance(value, (int, float)) and not isinstance(value, bool)
+                                    and self.buffer[end:end + 1] in self.NUMBER_CHARS):
+                    self.pos = end
+                    return value
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            self._fill(max(self.CHUNK, len(self.buffer) - self.pos))
+
+    def _keys(self):
+        """Yield the keys of the object that comes next. The caller has to read
+        the value of each key before asking for the next."""
+        self._expect('{')
+        if self._next_is('}'):
+            return
+        while True:
+            key = self._value()
+            if not isinstance(key, str):
+                self._fail('Expecting a property name')
+            self._expect(':')
+            yield key
+            if not self._next_is(','):
+                self._expect('}')
+                return
+
+    def _items(self, read=None):
+        """Yield the items of the array that comes next, as read by the given
+        function; if there is none, the caller has to read each item itself."""
+        self._expect('[')
+        if self._next_is(']'):
+            return
+        while True:
+            yield None if read is None else read()
+            if not self._next_is(','):
+                self._expect(']')
+                return
+
+
+def _xmlify(body, facsimile, metadata, members=None, special_chars=None, numeric_parser=None, postprocess=None,
+            fixups=None):
     """Take the extracted XML structure of from_sc and make sure it is
     well-formed. Also fix any shortcuts, e.g. for the glyph tags."""
     try:
-        content = etree.fromstring(txdata)
+        content = body.close()
     except etree.XMLSyntaxError as e:
+        txdata = body.text()
         message = "Parsing error in the JSON: %s\n" % e.msg
         # This is an option, not default, to reduce the amount of XML parsing error data generated.
         if metadata.get('short_error', False):
@@ -188,108 +424,36 @@ def _xmlify(txdata, facsimile, metadata, members=None, special_chars=None, numer
             wrap_ab = True
     if wrap_ab:
         print("WARNING: unblocked text detected. Wrapping in anonymous block", file=sys.stderr)
-        txdata = txdata.replace('<body>', '<body><ab>').replace('</body>', '</ab></body>')
-        try:
-            content = etree.fromstring(txdata)
-        except etree.XMLSyntaxError as e:
-            message = "Parsing error in block wrap: %s\n" % e.msg
-            if metadata.get('short_error', False):
-                message += _show_parsing_short_error(e, txdata)
-            else:
-                message += "Full string was %s" % txdata
-            safeerrmsg(message)
-            return
-
-    # First add values to the numbers if we have a way to.
-    if numeric_parser is not None:
-        for num in content.xpath('//num'):
-            if 'value' in num.keys():
-                try:
-                    float(num.get('value'))
-                    continue
-                except ValueError:
-                    pass
-            # If we get here, we haven't got a valid value.
-            numtext = etree.tostring(num, method='text', with_tail=False, encoding='utf-8').decode('utf-8')
-            try:
-                numval = numeric_parser(numtext)
-                float(numval)
-                num.set('value', numval.__str__())
-            except ValueError:
-                warn("Numeric parser could not parse data %s" % numtext)
-
-    # Now fix the glyph references.
+        ab = etree.Element('ab')
+        ab.text = content.text
+        content.text = None
+        ab.extend(content)
+        content.append(ab)
+
+    # Now go through the transcription once, fixing up the elements that need it:
+    # adding values to the numbers if we have a way to, fixing the glyph references,
+    # and correcting the old conventions. Then come any fixups of the user's own.
     glyphs_seen = {}
+    fixes = {'corr': _fix_corr, 'subst': _fix_rend, 'del': _fix_rend}
+    if numeric_parser is not None:
+        fixes['num'] = lambda el: _fix_num(el, numeric_parser)
     if special_chars is not None:
-        # LATER get this hard-coded list into a settings file. Or better yet, correct
-        # the transcriptions.
-        glyph_correction = {
-            'the': 'թե',
-            'thE': 'թէ',
-            'und': 'ընդ',
-            'thi': 'թի',
-            'asxarh': 'աշխարհ',
-            'pt': 'պտ',
-            'yr': 'յր',
-            'orpes': 'որպէս',
-        }
-        for glyph in content.xpath('//g'):
-            # Find the characters that we have glyph-marked. It could have been done
-            # in a couple of different ways.
-            glyphid = ''
-            gtext_explicit = False
-            # There might be an explicit 'ref' attribute, which may or may not have a non-empty value.
-            if glyph.get('ref'):
-                glyphid = glyph.get('ref')
-                if glyphid.find('#') == 0:  # The ref is meaningful and should be preserved.
-                    glyphid = glyphid[1:]
-            if glyph.text:
-                if glyphid == '':  # The glyph should be identified from the element text content.
-                    glyphid = glyph.text
-                else:
-                    gtext_explicit = True  # We have set a real ref and also text; both should be preserved.
-            if glyphid in glyph_correction:  # Check whether we need to use the hardcoded hack.
-                glyphid = glyph_correction[glyphid]
-            # Now figure out what the reference is for this glyph. Make the
-            # XML element if necessary.
-            if glyphid not in glyphs_seen:
-                try:
-                    glyphs_seen[glyphid] = _get_glyph(glyphid, special_chars)
-                except ValueError as e:
-                    lb = glyph.xpath('./preceding::lb[1]')[0]
-                    message = "In g element %s, line %s / %s, page %s:\n" % \
-                              (etree.tostring(glyph, encoding='utf-8', with_tail=False).decode('utf-8'),
-                               lb.get('{http://www.w3.org/XML/1998/namespace}id').lstrip('l'),
-                               lb.get('n'),
-                               glyph.xpath('./preceding::pb[1]')[0].get('n'))
-                    message += e.__str__() + "\n"
-                    safeerrmsg(message)
-                    return None
-            gref = '#%s' % glyphs_seen[glyphid].get('{http://www.w3.org/XML/1998/namespace}id')
-            # Finally, fix the 'g' element here so that it is canonical.
-            glyph.set('ref', gref)
-            if not gtext_explicit:
-                glyph.text = glyphid
-
-    for el in content.xpath('//corr'):
-        el.tag = 'subst'
-    # We should be using 'rend' and not 'type' for the subst and del tags.
-    for edit in content.xpath('//subst | //del'):
-        if edit.get('type'):
-            rend = edit.get('type')
-            edit.set('rend', rend)
-            edit.attrib.pop('type')
-
-    # And 'certainty' attributes have to have the value 'high, 'medium', or 'low'.
-    for el in content.xpath('//*[@cert]'):
-        certval = el.get('cert')
-        if re.match('^\d+$', certval):
-            if int(certval) >= 70:
-                el.set('cert', 'high')
-            elif int(certval) >= 45:
-                el.set('cert', 'medium')
-            else:
-                el.set('cert', 'low')
+        fixes['g'] = lambda el: _fix_glyph(el, special_chars, glyphs_seen)
+    if fixups is None:
+        fixups = {}
+    try:
+        for el in content.iter(etree.Element):
+            fix = fixes.get(el.tag)
+            if fix is not None:
+                fix(el)
+            if 'cert' in el.attrib:
+                _fix_cert(el)
+            fix = fixups.get(el.tag)
+            if fix is not None:
+                fix(el)
+    except _FixupError as e:
+        safeerrmsg(str(e))
+        return None
 
     return _tei_wrap(content, facsimile, metadata, members,
                      sorted(glyphs_seen.values(),
@@ -297,30 +461,137 @@ def _xmlify(txdata, facsimile, metadata, members=None, special_chars=None, numer
                      postprocess)
 
 
+class _FixupError(Exception):
+    """Raised when an element of the transcription can't be fixed up, so that
+    no TEI document can be made of it. The message says what went wrong where."""
+
+
+def _fix_num(num, numeric_parser):
+    """Give the 'num' element a value, if it doesn't already have a valid one."""
+    if 'value' in num.keys():
+        try:
+            float(num.get('value'))
+            return
+        except ValueError:
+            pass
+    # If we get here, we haven't got a valid value.
+    numtext = etree.tostring(num, method='text', with_tail=False, encoding='utf-8').decode('utf-8')
+    try:
+        numval = numeric_parser(numtext)
+        float(numval)
+        num.set('value', numval.__str__())
+    except ValueError:
+        warn("Numeric parser could not parse data %s" % numtext)
+
+
+# LATER get this hard-coded list into a settings file. Or better yet, correct
+# the transcriptions.
+_GLYPH_CORRECTION = {
+    'the': 'թե',
+    'thE': 'թէ',
+    'und': 'ընդ',
+    'thi': 'թի',
+    'asxarh': 'աշխարհ',
+    'pt': 'պտ',
+    'yr': 'յր',
+    'orpes': 'որպէս',
+}
+
+
+def _fix_glyph(glyph, special_chars, glyphs_seen):
+    """Make the 'g' element canonical, and add the glyph it refers to to those seen."""
+    # Find the characters that we have glyph-marked. It could have been done
+    # in a couple of different ways.
+    glyphid = ''
+    gtext_explicit = False
+    # There might be an explicit 'ref' attribute, which may or may not have a non-empty value.
+    if glyph.get('ref'):
+        glyphid = glyph.get('ref')
+        if glyphid.find('#') == 0:  # The ref is meaningful and should be preserved.
+            glyphid = glyphid[1:]
+    if glyph.text:
+        if glyphid == '':  # The glyph should be identified from the element text content.
+            glyphid = glyph.text
+        else:
+            gtext_explicit = True  # We have set a real ref and also text; both should be preserved.
+    if glyphid in _GLYPH_CORRECTION:  # Check whether we need to use the hardcoded hack.
+        glyphid = _GLYPH_CORRECTION[glyphid]
+    # Now figure out what the reference is for this glyph. Make the
+    # XML element if necessary.
+    if glyphid not in glyphs_seen:
+        try:
+            glyphs_seen[glyphid] = _get_glyph(glyphid, special_chars)
+        except ValueError as e:
+            lb = glyph.xpath('./preceding::lb[1]')[0]
+            message = "In g element %s, line %s / %s, page %s:\n" % \
+                      (etree.tostring(glyph, encoding='utf-8', with_tail=False).decode('utf-8'),
+                       lb.get('{http://www.w3.org/XML/1998/namespace}id').lstrip('l'),
+                       lb.get('n'),
+                       glyph.xpath('./preceding::pb[1]')[0].get('n'))
+            message += e.__str__() + "\n"
+            raise _FixupError(message)
+    gref = '#%s' % glyphs_seen[glyphid].get('{http://www.w3.org/XML/1998/namespace}id')
+    # Finally, fix the 'g' element here so that it is canonical.
+    glyph.set('ref', gref)
+    if not gtext_explicit:
+        glyph.text = glyphid
+
+
+def _fix_corr(el):
+    """Turn the erroneous 'corr' element into a 'subst' one."""
+    el.tag = 'subst'
+    _fix_rend(el)
+
+
+def _fix_rend(edit):
+    """We should be using 'rend' and not 'type' for the subst and del tags."""
+    if edit.get('type'):
+        rend = edit.get('type')
+        edit.set('rend', rend)
+        edit.attrib.pop('type')
+
+
+def _fix_cert(el):
+    """And 'certainty' attributes have to have the value 'high, 'medium', or 'low'."""
+    certval = el.get('cert')
+    if re.match('^\d+$', certval):
+        if int(certval) >= 70:
+            el.set('cert', 'high')
+        elif int(certval) >= 45:
+            el.set('cert', 'medium')
+        else:
+            el.set('cert', 'low')
+
+
+def _tei(tag):
+    """Returns the name of the given element in the TEI namespace."""
+    return '{%s}%s' % (_TEI_NS, tag)
+
+
 def _get_glyph(gname, special_chars):
     """Returns a TEI XML 'glyph' element for the given string."""
     # LATER get this hard-coded list into a settings file.
     if gname not in special_chars:
         raise ValueError("Glyph %s not recognized" % gname)
 
-    glyph_el = etree.Element('glyph')
+    glyph_el = etree.Element(_tei('glyph'))
     glyph_el.set('{http://www.w3.org/XML/1998/namespace}id', '%s' % special_chars[gname][0])
-    etree.SubElement(glyph_el, 'glyphName').text = special_chars[gname][1]
-    etree.SubElement(glyph_el, 'mapping').text = gname
+    etree.SubElement(glyph_el, _tei('glyphName')).text = special_chars[gname][1]
+    etree.SubElement(glyph_el, _tei('mapping')).text = gname
     return glyph_el
 
 
 def _make_surface(sinfo):
     """Returns a TEI XML 'surface' element for the given surface
     information, including graphic and zone geometry."""
-    surface_el = etree.Element('surface')
+    surface_el = etree.Element(_tei('surface'))
     surface_el.set('ulx', '0')
     surface_el.set('uly', '0')
     surface_el.set('lrx', "%d" % sinfo['width'])
     surface_el.set('lry', "%d" % sinfo['height'])
-    etree.SubElement(surface_el, 'graphic').set('url', sinfo['graphic'])
+    etree.SubElement(surface_el, _tei('graphic')).set('url', sinfo['graphic'])
     for zone in sinfo['zones']:
-        z_el = etree.SubElement(surface_el, 'zone')
+        z_el = etree.SubElement(surface_el, _tei('zone'))
         z_el.set('{http://www.w3.org/XML/1998/namespace}id', 'z%s' % zone['id'])
         z_el.set('ulx', zone['points'][0])
         z_el.set('uly', zone['points'][1])
@@ -375,81 +646,165 @@ def _tei_wrap(content, facsimile, metadata, members, glyphs, postprocess):
             metadata[key] = defaults[key]
 
     # Now make the outer TEI wrapper and the header for the content we have been passed.
-    tei = etree.Element('TEI')
-    file_desc = etree.SubElement(etree.SubElement(tei, 'teiHeader'), 'fileDesc')
-    title_stmt = etree.SubElement(file_desc, 'titleStmt')
-    etree.SubElement(title_stmt, 'title').text = metadata['title']
+    tei = etree.Element(_tei('TEI'), nsmap={None: _TEI_NS})
+    tei_header = etree.SubElement(tei, _tei('teiHeader'))
+    file_desc = etree.SubElement(tei_header, _tei('fileDesc'))
+    title_stmt = etree.SubElement(file_desc, _tei('titleStmt'))
+    etree.SubElement(title_stmt, _tei('title')).text = metadata['title']
     if 'author' in metadata:
-        etree.SubElement(title_stmt, 'author').text = metadata['author']
-    edition_stmt = etree.SubElement(file_desc, 'editionStmt')
-    etree.SubElement(edition_stmt, 'edition').text = 'T-Pen transcription'
+        etree.SubElement(title_stmt, _tei('author')).text = metadata['author']
+    edition_stmt = etree.SubElement(file_desc, _tei('editionStmt'))
+    etree.SubElement(edition_stmt, _tei('edition')).text = 'T-Pen transcription'
     if members is not None:
         # Add the transcribers that we have seen
         for mid, minfo in members.items():
-            resp_stmt = etree.SubElement(edition_stmt, 'respStmt')
+            resp_stmt = etree.SubElement(edition_stmt, _tei('respStmt'))
             resp_stmt.set('{http://www.w3.org/XML/1998/namespace}id', "u%s" % mid)
-            etree.SubElement(resp_stmt, 'resp').text = 'T-Pen transcriber'
+            etree.SubElement(resp_stmt, _tei('resp')).text = 'T-Pen transcriber'
             key = 'name'
             if key not in minfo:
                 key = 'uname'
-            etree.SubElement(resp_stmt, 'name').text = minfo.get(key, 'Anonymous')
-    etree.SubElement(etree.SubElement(file_desc, 'publicationStmt'), 'p').text = metadata['publicationStmt']
+            etree.SubElement(resp_stmt, _tei('name')).text = minfo.get(key, 'Anonymous')
+    etree.SubElement(etree.SubElement(file_desc, _tei('publicationStmt')), _tei('p')).text = metadata['publicationStmt']
 
     # Source and manuscript description
-    msdesc = etree.SubElement(etree.SubElement(file_desc, 'sourceDesc'), 'msDesc')
+    msdesc = etree.SubElement(etree.SubElement(file_desc, _tei('sourceDesc')), _tei('msDesc'))
     # Do we have a settlement/repository/ID defined? If so make the msIdentifier an XML ID.
     has_rich_id = 'msSettlement' in metadata or 'msRepository' in metadata or 'msIdNumber' in metadata
     if 'msIdentifier' in metadata:
-        desc_container = etree.SubElement(msdesc, 'msIdentifier')
+        desc_container = etree.SubElement(msdesc, _tei('msIdentifier'))
         if has_rich_id:
             msdesc.set('{http://www.w3.org/XML/1998/namespace}id', metadata['msIdentifier'])
             if 'msSettlement' in metadata:
-                etree.SubElement(desc_container, 'settlement').text = metadata['msSettlement']
+                etree.SubElement(desc_container, _tei('settlement')).text = metadata['msSettlement']
             if 'msRepository' in metadata:
-                etree.SubElement(desc_container, 'repository').text = metadata['msRepository']
+                etree.SubElement(desc_container, _tei('repository')).text = metadata['msRepository']
             if 'msIdNumber' in metadata:
-                etree.SubElement(desc_container, 'idno').text = metadata['msIdNumber']
+                etree.SubElement(desc_container, _tei('idno')).text = metadata['msIdNumber']
         else:  # If not, use the text content of the identifier as the XML msIdentifier content.
             desc_container.text = metadata['msIdentifier']
     has_origin = 'date' in metadata or 'location' in metadata
     if has_origin:
-        origin = etree.SubElement(etree.SubElement(msdesc, 'history'), 'origin')
+        origin = etree.SubElement(etree.SubElement(msdesc, _tei('history')), _tei('origin'))
         if 'date' in metadata:
-            etree.SubElement(origin, 'origDate').text = metadata['date']
+            etree.SubElement(origin, _tei('origDate')).text = metadata['date']
         if 'location' in metadata:
-            etree.SubElement(origin, 'origPlace').text = metadata['location']
+            etree.SubElement(origin, _tei('origPlace')).text = metadata['location']
     if 'description' in metadata:
-        etree.SubElement(msdesc, 'p').text = metadata['description']
+        etree.SubElement(msdesc, _tei('p')).text = metadata['description']
     # TODO consider filling out msContents / msItem
 
     # Then add the glyphs we used
     if len(glyphs):
-        etree.SubElement(etree.SubElement(tei.find('teiHeader'), 'encodingDesc'), 'charDecl').extend(glyphs)
+        etree.SubElement(etree.SubElement(tei_header, _tei('encodingDesc')), _tei('charDecl')).extend(glyphs)
     # Now make the facsimile element and its content
-    facs_el = etree.SubElement(tei, 'facsimile')
+    facs_el = etree.SubElement(tei, _tei('facsimile'))
     for surface in facsimile:
         facs_el.append(_make_surface(surface))
-    # Then add the content.
-    etree.SubElement(tei, 'text').append(content)
-    # Finally, set the appropriate namespace and schema.
-    tei.set('xmlns', 'http://www.tei-c.org/ns/1.0')
+    # Then add the content, and put the elements of the transcription that
+    # don't have a namespace of their own into the TEI one.
+    etree.SubElement(tei, _tei('text')).append(content)
+    for el in content.iter(etree.Element):
+        if not el.tag.startswith('{'):
+            el.tag = _tei(el.tag)
+    # Finally, set the schema.
     tei_doc = etree.ElementTree(tei)
     pi = 'href="%s" type="application/xml" schematypens="http://relaxng.org/ns/structure/1.0"' % metadata['teiSchema']
     schema = etree.ProcessingInstruction('xml-model', pi)
     tei.addprevious(schema)
-    # Now that we've done this, serialize and re-parse the entire TEI doc
-    # so that the namespace functionality works.
-    try:
-        tei_doc = etree.parse(BytesIO(etree.tostring(tei_doc)))
-    except etree.XMLSyntaxError as e:
-        message = "Error in final parse: "
-        message += _show_parsing_short_error(e, etree.tostring(tei_doc, encoding="utf-8").decode('utf-8'))
-        safeerrmsg(message)
     if postprocess is not None:
         postprocess(tei_doc)
     return tei_doc
 
 
+def convert_files(jsonfiles, outdir, metadata=None, jobs=1, force=False):
+    """Convert each of the given SC-JSON files to TEI XML, in a file of the same name
+    but ending in .xml in the directory outdir. A file whose output is already there,
+    and newer than it, is skipped unless force is set. If jobs is more than 1, that
+    many files are converted at once in separate processes. The optional metadata
+    is passed to from_sc_stream for each file.
+
+    Yields the outcome of each conversion in the order of jsonfiles, as a dictionary
+    with the keys 'infile', 'outfile', 'status' (one of 'converted', 'skipped', or
+    'failed'), 'seconds', and 'messages', which holds anything the conversion had to
+    say about the file.
+    """
+    outfiles = {}
+    for infile in jsonfiles:
+        outfile = os.path.join(outdir, os.path.splitext(os.path.basename(infile))[0] + '.xml')
+        if outfile in outfiles:
+            raise ValueError('Both %s and %s would be converted to %s' % (outfiles[outfile], infile, outfile))
+        outfiles[outfile] = infile
+    os.makedirs(outdir, exist_ok=True)
+    todo = []
+    for outfile, infile in outfiles.items():
+        if not force and os.path.exists(infile) and os.path.exists(outfile) \
+                and os.path.getmtime(outfile) >= os.path.getmtime(infile):
+            todo.append(None)
+        else:
+            todo.append((infile, outfile, metadata))
+    if jobs > 1:
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            done = executor.map(_convert_file, [t for t in todo if t is not None])
+            for (outfile, infile), task in zip(outfiles.items(), todo):
+                yield _skipped(infile, outfile) if task is None else next(done)
+    else:
+        for (outfile, infile), task in zip(outfiles.items(), todo):
+            yield _skipped(infile, outfile) if task is None else _convert_file(task)
+
+
+def _skipped(infile, outfile):
+    return {'infile': infile, 'outfile': outfile, 'status': 'skipped', 'seconds': 0.0, 'messages': ''}
+
+
+def _convert_file(task):
+    """Convert one SC-JSON file to TEI XML, for convert_files. The XML is written
+    to a temporary file that takes the place of the output only when it is
+    complete, so that a failed conversion never leaves an output that looks new."""
+    infile, outfile, metadata = task
+    start = time.perf_counter()
+    status = 'failed'
+    messages = io.StringIO()
+    with redirect_stdout(messages), redirect_stderr(messages), catch_warnings():
+        simplefilter('always')
+        try:
+            with open(infile, encoding='utf-8') as jfile:
+                # from_sc adds the metadata of the file to what it is given.
+                xmltree = from_sc_stream(jfile, metadata=dict(metadata or {}))
+            if xmltree is not None:
+                fd, tmpname = tempfile.mkstemp(dir=os.path.dirname(outfile), suffix='.tmp')
+                try:
+                    with os.fdopen(fd, 'wb') as out:
+                        out.write(_serialize(xmltree))
+                    os.replace(tmpname, outfile)
+                except BaseException:
+                    os.unlink(tmpname)
+                    raise
+                status = 'converted'
+        except Exception as e:
+            print("%s: %s" % (type(e).__name__, e), file=sys.stderr)
+    return {'infile': infile, 'outfile': outfile, 'status': status,
+            'seconds': time.perf_counter() - start, 'messages': messages.getvalue()}
+
+
+def _serialize(xmltree):
+    return etree.tostring(xmltree, encoding='utf-8', pretty_print=True, xml_declaration=True)
+
+
+def _find_inputs(specs):
+    """Turn the files, directories, and glob patterns given on the command line
+    into a list of files. A directory stands for the .json files in it."""
+    found = []
+    for spec in specs:
+        if os.path.isdir(spec):
+            found.extend(sorted(glob.glob(os.path.join(spec, '*.json'))))
+        elif any(c in spec for c in '*?['):
+            found.extend(sorted(glob.glob(spec)))
+        else:
+            found.append(spec)
+    return list(OrderedDict.fromkeys(found))
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument(
@@ -463,13 +818,50 @@ if __name__ == '__main__':
         help="Reduce the amount of error output on XML parsing failures"
     )
     parser.add_argument(
-        "infile",
-        help="SC-JSON file containing a T-PEN transcription",
+        "-o", "--outdir",
+        help="Directory to write a TEI XML file to for each input file, instead of writing a single one to stdout",
+    )
+    parser.add_argument(
+        "-j", "--jobs",
+        type=int,
+        default=1,
+        help="Number of files to convert in parallel, with --outdir",
+    )
+    parser.add_argument(
+        "-f", "--force",
+        action="store_true",
+        help="Convert files even if their output is newer than they are, with --outdir",
+    )
+    parser.add_argument(
+        "infiles",
+        nargs="+",
+        metavar="infile",
+        help="SC-JSON file containing a T-PEN transcription; with --outdir, also directories and glob patterns",
     )
     args = parser.parse_args()
-    with open(args.infile, encoding='utf-8') as jfile:
-        msdata = json.load(jfile)
     default_metadata = {'title': args.title, 'short_error': args.short_error}
-    xmltree = from_sc(msdata, metadata=default_metadata)
-    if xmltree is not None:
-        sys.stdout.buffer.write(etree.tostring(xmltree, encoding='utf-8', pretty_print=True, xml_declaration=True))
+    if args.outdir is None:
+        if len(args.infiles) > 1:
+            parser.error("only one infile can be converted without --outdir")
+        with open(args.infiles[0], encoding='utf-8') as jfile:
+            xmltree = from_sc_stream(jfile, metadata=default_metadata)
+        if xmltree is not None:
+            sys.stdout.buffer.write(_serialize(xmltree))
+    else:
+        started = time.perf_counter()
+        counts = OrderedDict((status, 0) for status in ('converted', 'skipped', 'failed'))
+        try:
+            for result in convert_files(_find_inputs(args.infiles), args.outdir, metadata=default_metadata,
+                                        jobs=args.jobs, force=args.force):
+                counts[result['status']] += 1
+                if result['status'] == 'skipped':
+                    print("%s: up to date" % result['infile'])
+                else:
+                    print("%s: %s in %.2fs" % (result['infile'], result['status'], result['seconds']))
+                if result['messages']:
+                    print(result['messages'].rstrip('\n'), file=sys.stderr)
+        except ValueError as e:
+            parser.error(str(e))
+        print("%s in %.2fs" % (', '.join('%d %s' % (n, status) for status, n in counts.items()), time.perf_counter() - started))
+        if counts['failed']:
+            sys.exit(1)
@@ -1,5 +1,14 @@
 # -*- encoding: utf-8 -*-
+import argparse
+from collections import OrderedDict
+import hashlib
+import io
 import json
+import os
+import pickle
+import tempfile
+import zlib
+from concurrent.futures import ProcessPoolExecutor
 from lxml import etree
 import re
 import sys
@@ -15,293 +24,710 @@ class Tokenizer:
     * first_layer: Instead of using the final layer (e.g. <add> tags, use the first (a.c.)
       layer of the text (e.g. <del> tags).
     * punctuation: A list of punctuation characters that should be split into its own tokens.
-    * normalisation: A function that takes a token and rewrites that token's normalised form,
-      if desired.
+    * normalisation: A function that takes a token and rewrites its normalised form (and, if
+      it likes, its own copies of the location fields); or a Normaliser, or a BatchNormaliser.
     * id_xpath: An XPath expression that returns a string that should be used as the manuscript's
       identifier in CollateX output. Defaults to '//t:msDesc/@xml:id'. (Note that the TEI namespace
       should be abbreviated as 't'.)
     * block_xpath: An XPath expression that returns a list of paragraph- or stanza-level blocks
       from which the tokens should be extracted. It will be executed relative to the <text> element.
       Defaults to './/t:p | .//t:ab'.
-      """
+    * fields: The token fields to produce, out of TOKEN_FIELDS (by default, all of them); the
+      ones left out are not worked out at all, which makes tokenization quicker.
+    * jobs: The number of processes to tokenize the blocks of a single document in.
+    * block_cache: A BlockCache, to keep the tokens of each block for when it is read again.
+    * witness_cache: A WitnessCache, to keep the results for whole documents on disk.
+
+    The location fields of the tokens that are returned (section, paragraph, page, column,
+    line) are read-only records, shared by all the tokens in the same place. Changing one
+    in place raises a TypeError; to change it, replace it, e.g. with dict(token['line'], n='2').
+    """
 
     IDTAG = '{http://www.w3.org/XML/1998/namespace}id'   # xml:id; useful for debugging
     MILESTONE = None
-    INMILESTONE = True
     first_layer = None
     punctuation = None
     normalisation = None
     id_xpath = None
     block_xpath = './/t:p | .//t:ab'
-    xml_doc = None
+    fields = None
+    jobs = 1
+    block_cache = None
+    witness_cache = None
 
-    def __init__(self, milestone=None, first_layer=False, punctuation=None, normalisation=None, id_xpath=None, block_xpath=None):
-        if milestone is not None:
-            self.MILESTONE = milestone
-            self.INMILESTONE = False
+    def __init__(self, milestone=None, first_layer=False, punctuation=None, normalisation=None, id_xpath=None,
+                 block_xpath=None, fields=None, jobs=1, block_cache=None, witness_cache=None):
+        # The tokenizer holds only its configuration. Everything to do with the
+        # document being tokenized lives in a _DocumentState for that call, so that
+        # a single tokenizer can be shared between threads, or pickled.
+        self.MILESTONE = milestone
         self.first_layer = first_layer
         self.punctuation = punctuation
         self.normalisation = normalisation
         self.id_xpath = id_xpath
         if block_xpath is not None:
             self.block_xpath = block_xpath
+        self.fields = fields
+        self.jobs = jobs
+        self.block_cache = block_cache
+        self.witness_cache = witness_cache
+        # Compile what we can of the configuration once, for all the documents
+        # we will tokenize.
+        self._plan = _Plan(first_layer, punctuation, normalisation, id_xpath, self.block_xpath, fields)
+
+    def from_file(self, xmlfile, encoding='utf-8', both_layers=False):
+        if self.witness_cache is None:
+            with open(xmlfile, encoding=encoding) as fh:
+                return self.from_fh(fh, both_layers)
+        # Look the file up in the cache by its contents, and parse it only if we
+        # have to.
+        with open(xmlfile, 'rb') as fh:
+            document = fh.read()
 
-    def from_file(self, xmlfile, encoding='utf-8'):
-        with open(xmlfile, encoding=encoding) as fh:
-            return self.from_fh(fh)
+        def tokenize():
+            with io.TextIOWrapper(io.BytesIO(document), encoding=encoding) as fh:
+                return self._from_element(etree.parse(fh).getroot(), both_layers)
+        digest = self._witness_digest(document, encoding, both_layers)
+        if digest is None:
+            return tokenize()
+        return self.witness_cache.fetch(digest, tokenize)
 
-    def from_fh(self, xml_fh):
+    def from_fh(self, xml_fh, both_layers=False):
         xmldoc = etree.parse(xml_fh)           # returns an ETree
-        return self.from_etree(xmldoc)
+        return self.from_etree(xmldoc, both_layers)
 
-    def from_string(self, xml_string):
+    def from_string(self, xml_string, both_layers=False):
         xmlobj = etree.fromstring(xml_string)  # returns an Element
-        return self.from_element(xmlobj)
+        return self.from_element(xmlobj, both_layers)
 
-    def from_etree(self, xml_doc):
-        return self.from_element(xml_doc.getroot())
+    def from_etree(self, xml_doc, both_layers=False):
+        return self.from_element(xml_doc.getroot(), both_layers)
 
-    def from_element(self, xml_object):
+    def from_element(self, xml_object, both_layers=False):
         """Take a TEI XML file as input, and return a JSON structure suitable
-        for passing to CollateX."""
+        for passing to CollateX. If both_layers is set, the text is read once for
+        both its final and its first layer, whatever the first_layer option says,
+        and a pair of these structures is returned: the final layer, then the first."""
+        if self.witness_cache is None:
+            return self._from_element(xml_object, both_layers)
+        # The document is known to the cache by its serialized form, along with
+        # where in it the element is.
+        tree = xml_object.getroottree()
+        document = etree.tostring(tree) + tree.getpath(xml_object).encode('utf-8')
+        digest = self._witness_digest(document, None, both_layers)
+        if digest is None:
+            return self._from_element(xml_object, both_layers)
+        return self.witness_cache.fetch(digest, lambda: self._from_element(xml_object, both_layers))
 
-        # (Re)set xml_doc from the element we are now using
-        self.xml_doc = etree.ElementTree(xml_object)
+    def _from_element(self, xml_object, both_layers=False):
+        wanted = None if self.MILESTONE is None else [self.MILESTONE]
+        layers = self._plan.both if both_layers else (self._plan.discard,)
+        sections = self._tokenize(xml_object, wanted, layers)
+        sigil = self._sigil(xml_object)
+        witnesses = tuple({'id': sigil, 'tokens': list(self._finish(sections.get((layer, self.MILESTONE), [])))}
+                          for layer in range(len(layers)))
+        return witnesses if both_layers else witnesses[0]
 
-        ns = {'t': 'http://www.tei-c.org/ns/1.0'}
+    def _witness_digest(self, document, encoding, both_layers):
+        """Return the hash that the result of tokenizing the given document, with
+        our options, is kept under in the witness cache; or None if our normalisation
+        can't be told apart from others, so that its results can't be kept."""
+        try:
+            normalisation = _identity(self.normalisation)
+        except _Unidentifiable:
+            return None
+        digest = hashlib.sha256(document)
+        config = (WitnessCache.VERSION, encoding, both_layers, self.MILESTONE, self.first_layer, self.punctuation,
+                  self.id_xpath, self.block_xpath, self.fields, normalisation)
+        digest.update(repr(config).encode('utf-8'))
+        return digest.hexdigest()
 
-        # Extract a witness ID from the XML. Remove any extraneous spaces
-        # from the value(s) selected by the XPath expression.
-        sigil = "TEI MS"
-        if self.id_xpath is not None:
-            ids = xml_object.xpath(self.id_xpath, namespaces=ns)
-            if len(ids):
-                sigil = ' '.join([x.rstrip().lstrip() for x in ids])
+    def sections_from_etree(self, xml_doc, milestones=None):
+        return self.sections_from_element(xml_doc.getroot(), milestones)
+
+    def sections_from_element(self, xml_object, milestones=None):
+        """Tokenize the sections of a TEI XML document that begin at the given
+        milestones (by default, all of them) in a single pass. Returns a dictionary
+        keyed on milestone n, whose values are what from_element would return for
+        a Tokenizer with that milestone option."""
+        index = milestone_index(xml_object)
+        if milestones is None:
+            milestones = list(index.keys())
+        sections = self._tokenize(xml_object, milestones, (self._plan.discard,), index)
+        sigil = self._sigil(xml_object)
+        return {n: {'id': sigil, 'tokens': list(self._finish(sections.get((0, n), [])))}
+                for n in milestones}
 
-        # Extract the text itself from the XML
-        thetext = xml_object.xpath('//t:text', namespaces=ns)[0]
-        tokens = []
+    def _tokenize(self, xml_object, wanted, layers, index=None):
+        """Find the raw tokens in the text of the given document, and return them
+        in a dictionary keyed on the layer and the milestone section they belong to.
+        The layers are given as the tags to discard for each; the first is layer 0.
+        If we want only some sections, pass their milestone n values as 'wanted',
+        along with the milestone index of the document if we have it; otherwise
+        the whole text is returned under the section None."""
+        # Extract the text itself from the XML, and the paragraph-like blocks in it.
+        thetext = _TEXT_XPATH(xml_object)[0]
+        blocks = self._plan.blocks(thetext)
+        if wanted is not None and index is None:
+            index = milestone_index(xml_object)
+        if self.jobs > 1 and len(blocks) > 1 and self.block_cache is None:
+            return self._tokenize_parallel(xml_object, wanted, layers, blocks, index)
+        return self._tokenize_blocks(xml_object, wanted, layers, blocks, index)
+
+    def _tokenize_blocks(self, xml_object, wanted, layers, blocks, index=None, starts=None, paths=None,
+                         locators=None):
+        """Find the raw tokens in the given blocks of a document, as _tokenize does.
+        If the blocks don't begin the text, the sections that they begin in are
+        given as 'starts'. If they have been taken out of the document, the element
+        paths of each block and of its parent are given as 'paths', and the
+        _Locators that they begin with as 'locators', as far as we need them."""
+        # Where each node sits in the document is worked out as we come to it, if
+        # we need to know.
+        locations = _Locations() if self._plan.locations else {}
+        state = _DocumentState(xml_object, locations, wanted, layers, index, self._plan.lit, self._plan.locations)
+        if paths is not None:
+            for block, (path, parent) in zip(blocks, paths):
+                state.paths[block.getparent()] = parent
+                state.paths[block] = path
+        sections = {}
+        # Past the last block with a milestone that we want in it, once we are
+        # outside the sections that we want, there is nothing more to find.
+        last = None
+        if state.within is not None:
+            last = max((i for i, block in enumerate(blocks) if block in state.within), default=-1)
+        follows = False
 
         # For each paragraph-like block remaining in the text, break it up into words.
-        blocks = thetext.xpath(self.block_xpath, namespaces=ns)
+        for i, block in enumerate(blocks):
+            if starts is not None:
+                state.current = starts[i]
+            if state.skippable(block):
+                if last is not None and i > last:
+                    break
+                follows = False
+                continue
+            if len(self._plan.locations):
+                if locators is None:
+                    locations.seek(block, follows)
+                else:
+                    locations.seek(block, False, locators[i])
+                follows = True
+            if self.block_cache is None:
+                found = self._find_words(state, block)
+            else:
+                found = self._cached_words(state, block)
+            for key, tokens in found.items():
+                sections.setdefault(key, []).extend(tokens)
+        return sections
+
+    def _cached_words(self, state, block):
+        """Find the tokens of a block as _find_words does, unless the block cache
+        has them already, in which case we go on to the milestone section that the
+        block ends in."""
+        digest = self._block_digest(state, block)
+        cached = self.block_cache.get(digest)
+        if cached is not None:
+            found, state.current = cached
+            return found
+        found = self._find_words(state, block)
+        self.block_cache.put(digest, found, state.current)
+        return found
+
+    def _block_digest(self, state, block):
+        """Return a hash of everything that the tokens of a block depend on: the
+        serialized block (with its tail), what we are reading it for, the section
+        it begins in, and the element path and the location that it has."""
+        digest = hashlib.sha1(etree.tostring(block))
+        wanted = None if state.wanted is None else sorted(state.wanted)
+        layers = [sorted(tags) for tags in state.layers]
+        path = state.path(block)[0] if self._plan.context else None
+        location = None
+        if len(self._plan.locations):
+            location = [None if el is None else _xmljson(el) for el in state.locations[block]]
+        digest.update(repr((wanted, layers, self.punctuation, self.fields, state.current, path, location))
+                      .encode('utf-8'))
+        return digest.hexdigest()
+
+    def _tokenize_parallel(self, xml_object, wanted, layers, blocks, index=None):
+        """Find the raw tokens in the blocks of a document as _tokenize does, with
+        runs of the blocks tokenized at once in separate processes. The result is the
+        same as if they had been tokenized one after another."""
+        # Each process is handed only the blocks that it tokenizes, serialized, and
+        # whatever they would have had from the rest of the document: the milestone
+        # section that each begins in, and if need be its element path and that of
+        # its parent, and the location it begins in. The only thing that one block
+        # passes on to the next is the section that it ends in, which is that of
+        # the last milestone in it.
+        if wanted is not None and index is None:
+            index = milestone_index(xml_object)
+        state = _DocumentState(xml_object, {}, wanted, layers, index)
+        kept = []
+        starts = []
+        paths = [] if self._plan.context else None
+        locations = [] if len(self._plan.locations) else None
+        since = None
+        current = None
         for block in blocks:
-            tokens.extend(self._find_words(block, self.first_layer))
-        # Back to the top level: remove any empty tokens that were left over
-        # in case they were needed to close a seemingly incomplete word.
-        tokens = [t for t in tokens if not _is_blank(t)]
-
-        # Now go through all the tokens and apply our function, if any, to normalise
-        # the token.
-        if self.normalisation is not None:
-            try:
-                normed = [self.normalisation(t) for t in tokens]
-            except:
-                raise
-            tokens = [n for n in normed if not _is_blank(n)]
+            state.current = current
+            if wanted is not None:
+                for milestone in block.iter(_MILESTONE):
+                    current = milestone.get('n')
+            if state.skippable(block):
+                continue
+            kept.append(block)
+            starts.append(state.current)
+            if paths is not None:
+                paths.append((state.path(block), state.path(block.getparent())))
+            if locations is not None:
+                since = (block, _Locator.at(block, since))
+                locations.append(since[1].location())
+        if len(kept) < 2:
+            # Not worth handing out to another process
+            return self._tokenize_blocks(xml_object, wanted, layers, kept, index, starts)
+        data = [etree.tostring(block) for block in kept]
+        # The processes don't need to normalise the tokens, which is done here.
+        worker = Tokenizer(first_layer=self.first_layer, punctuation=self.punctuation, id_xpath=self.id_xpath,
+                           block_xpath=self.block_xpath, fields=self.fields)
+        runs = _runs([len(d) for d in data], self.jobs)
+        sections = {}
+        with ProcessPoolExecutor(max_workers=len(runs)) as executor:
+            futures = []
+            for run in runs:
+                # The elements that define the locations are sent as their tags and
+                # attributes, each once.
+                elements = {}
+                located = None
+                if locations is not None:
+                    located = [tuple(None if el is None else elements.setdefault(el, len(elements))
+                                     for el in locations[i]) for i in run]
+                futures.append(executor.submit(
+                    _tokenize_run, worker, _run_document(kept[run.start:run.stop], data[run.start:run.stop]),
+                    wanted, layers, starts[run.start:run.stop], None if paths is None else paths[run.start:run.stop],
+                    located, [(el.tag, dict(el.attrib)) for el in elements]))
+            # Tokens never run on from one block to the next, so the runs are put
+            # back together in order as they are.
+            for future in futures:
+                for key, tokens in future.result().items():
+                    sections.setdefault(key, []).extend(tokens)
+        return sections
+
+    def stream_file(self, xmlfile, encoding='utf-8'):
+        """Tokenize a TEI XML file without loading the whole document into memory.
+        This returns the same structure as from_file, except that 'tokens' is a
+        generator, which reads the file one block at a time and discards each block
+        once its tokens have been produced.
+
+        The file is read twice: once quickly to take note of how its elements are
+        arranged, and then again to tokenize it. The witness ID is taken from the
+        part of the document that precedes the <text> element, and each element is
+        checked against block_xpath as it opens, against what has been read so far;
+        neither expression should therefore depend on what comes later in the file."""
+        return self._stream(lambda: xmlfile, encoding)
+
+    def stream_fh(self, xml_fh, encoding='utf-8'):
+        """As stream_file, but with a filehandle, which must be open in binary mode
+        and seekable."""
+        start = xml_fh.tell()
+
+        def rewind():
+            xml_fh.seek(start)
+            return xml_fh
+        return self._stream(rewind, encoding)
+
+    def _stream(self, source, encoding):
+        repeats = _repeated_tags(source(), encoding)
+        tokens = self._stream_tokens(source(), encoding, repeats)
+        # The first thing the stream gives back is the sigil.
+        sigil = next(tokens)
+        return {'id': sigil, 'tokens': self._finish(tokens)}
+
+    def _stream_tokens(self, source, encoding, repeats):
+        """Parse the document incrementally and yield its sigil, followed by the raw
+        tokens of each block as the block is completed. Everything that has been
+        tokenized, or that lies outside a block, is thrown away as we go."""
+        # As we can't look back at the document, we work out the location and the
+        # element path of each node as it is parsed.
+        state = _DocumentState(None, {}, None if self.MILESTONE is None else [self.MILESTONE],
+                               (self._plan.discard,), None, self._plan.lit, self._plan.locations)
+        locator = _Locator()
+        # The open elements, each with its ordinal and a count of its children by tag
+        stack = []
+        ordinal = 0
+        thetext = None
+        blocks = None
+        inblock = None  # the open block we are in, if any
+        pending = None  # a finished block, whose tail we might not yet have
+        for event, node in etree.iterparse(source, events=('start', 'end', 'comment', 'pi'),
+                                           encoding=encoding):
+            if pending is not None:
+                yield from self._stream_block(state, pending, blocks)
+                state.release(pending)
+                pending = None
+
+            if event == 'start':
+                state.locations[node] = locator.start(node)
+                if len(stack):
+                    parent, parent_ordinal, seen = stack[-1]
+                    seen[node.tag] = seen.get(node.tag, 0) + 1
+                    step = node.tag
+                    if node.tag in repeats.get(parent_ordinal, ()):
+                        step += '[%d]' % seen[node.tag]
+                    state.paths[node] = _child_path(state.paths[parent], step)
+                else:
+                    state.paths[node] = ('.', '.')
+                stack.append((node, ordinal, {}))
+                ordinal += 1
+
+                if thetext is None and node.tag == _TEXT:
+                    # We have everything we will get for the sigil. Give it back, and
+                    # throw away what came before.
+                    thetext = node
+                    yield self._sigil(node.getroottree().getroot())
+                    state.release(node, keep=True)
+                    blocks = _BlockFinder(thetext, self._plan.blocks)
+                if thetext is not None and inblock is None and blocks.is_block(node):
+                    inblock = node
+            elif event == 'end':
+                locator.end(node)
+                stack.pop()
+                if node is inblock:
+                    inblock = None
+                    pending = node
+                elif inblock is None and thetext is not None:
+                    state.release(node)
+            else:
+                # Comments and processing instructions
+                state.locations[node] = locator.start(node)
+        if thetext is None:
+            raise ValueError("No text element found in the document")
+        if pending is not None:
+            yield from self._stream_block(state, pending, blocks)
+
+    def _stream_block(self, state, block, blocks):
+        """Yield the raw tokens of a streamed block, and of any blocks inside it."""
+        for b in [block] + blocks.inner(block):
+            yield from self._find_words(state, b).get((0, self.MILESTONE), [])
+
+    def _sigil(self, xml_object):
+        """Extract a witness ID from the XML. Remove any extraneous spaces
+        from the value(s) selected by the XPath expression."""
+        sigil = "TEI MS"
+        if self._plan.sigil is not None:
+            ids = self._plan.sigil(xml_object)
+            if len(ids):
+                sigil = ' '.join([x.rstrip().lstrip() for x in ids])
+        return sigil
 
+    def _finish(self, tokens):
+        """Tidy up the raw tokens from the blocks of a document, and normalise them."""
+        if self._plan.batch is not None:
+            tokens = self._normalise_batches(tokens)
+        last = None
+        for token in tokens:
+            # Remove any empty tokens that were left over in case they were
+            # needed to close a seemingly incomplete word.
+            if _is_blank(token):
+                continue
+            # Apply our function, if any, to normalise the token.
+            if self._plan.normalisation is not None and self._plan.batch is None:
+                for field in self._plan.hidden:
+                    token.pop(field, None)
+                records = _detach(token)
+                token = self._plan.normalisation(token)
+                if _is_blank(token):
+                    continue
+                _reattach(token, records)
+            # Drop whatever fields we only kept for our own use.
+            for field in self._plan.dropped:
+                token.pop(field, None)
+            if last is not None:
+                yield last
+            last = token
         # Account for the possibility that a space was forgotten at the end of the
         # section or document
-        if len(tokens) > 0 and 'continue' in tokens[-1]:
-            del tokens[-1]['continue']
-
-        return {'id': sigil, 'tokens': tokens}
-
-    def _find_words(self, element, first_layer=False):
-        """Detect word boundaries and add an anchor to each."""
-        tokens = []
-        # First handle the text of the element, if any
-        if element.tag is not etree.Comment and element.text is not None:
-            self._split_text_node(element, element.text, tokens)
-
-        # Next handle the child elements of this one, if any.
-        for child in element:
-            child_tokens = self._find_words(child, first_layer)
-            if len(child_tokens) == 0:
+        if last is not None:
+            if 'continue' in last:
+                del last['continue']
+            yield last
+
+    def _normalise_batches(self, tokens):
+        """Normalise the non-blank tokens a batch at a time: all of them at once if
+        we have them all, or else as many as we have when a batch is full."""
+        if isinstance(tokens, list):
+            batches = [tokens]
+        else:
+            batches = _batched(tokens, _BATCH_SIZE)
+        for batch in batches:
+            batch = [t for t in batch if not _is_blank(t)]
+            for token in batch:
+                for field in self._plan.hidden:
+                    token.pop(field, None)
+            if not self._plan.sees_tokens:
+                yield from self._plan.batch(batch)
                 continue
-            if len(tokens) and 'continue' in tokens[-1]:
-                # Try to combine the last of these with the first child token.
-                combolit = "<word>%s</word>" % (tokens[-1]['lit'] + child_tokens[0]['lit'])
-                try:
-                    etree.fromstring(combolit)
-                    # If this didn't cause an exception, merge the tokens
-                    prior = tokens[-1]
-                    partial = child_tokens.pop(0)
-                    prior['t'] += partial['t']
-                    prior['n'] += partial['n']
-                    # Now figure out 'lit'. Did the child have children?
-                    if child.text is None and len(child) == 0:
-                        # It's a milestone element. Stick it into 'lit'.
-                        prior['lit'] += _shortform(etree.tostring(child, encoding='unicode', with_tail=False))
-                    prior['lit'] += partial['lit']
-                    if 'continue' not in partial:
-                        del prior['continue']
-                except etree.XMLSyntaxError:
-                    pass
-            # Add the remaining tokens onto our list.
-            tokens.extend(child_tokens)
+            records = [_detach(t) for t in batch]
+            normalised = self._plan.batch(batch)
+            for token, copied in zip(batch, records):
+                _reattach(token, copied)
+            yield from normalised
+
+    def _find_words(self, state, element):
+        """Detect word boundaries and add an anchor to each. Returns a dictionary
+        of the tokens found, keyed on the layer (by its index in state.layers) and
+        the milestone section they belong to (or None if we aren't looking for
+        milestones).
+
+        The tree is walked with a stack of the elements we are in rather than by
+        recursion, so that deeply nested markup is no problem. All the elements
+        add their tokens to the same lists, one for each layer and section; each
+        element notes where its own tokens begin in them. The tokens of the options
+        inside a <choice> are kept apart, since the choice logic needs them one
+        by one."""
+        found = {}
+        frames = state.frames
+        # We might be inside a <choice> whose options are being tokenized again.
+        base = len(frames)
+        self._open(state, element, found)
+        while True:
+            frame = frames[-1]
+            child = next(frame.children, None)
+            if child is not None:
+                if not state.skippable(child):
+                    self._open(state, child, frame.found if frame.options is None else {})
+                continue
+            self._close(state, frame)
+            frames.pop()
+            if len(frames) == base:
+                return found
+            parent = frames[-1]
+            if parent.options is not None:
+                parent.options[frame.element] = frame.found
+                continue
+            # Join the first token of the child onto what came before it in the
+            # parent, if the word continues.
+            for key, start in frame.starts.items():
+                self._join_child(state, frame.found[key], parent.starts[key], start, frame.element)
+
+    def _open(self, state, element, found):
+        """Start on an element, whose tokens are to be added to the lists in found,
+        by handling its text."""
+        frame = _Frame(element, found, state.passed)
+        state.frames.append(frame)
+        # Handle the text of the element, if any
+        if element.tag is not etree.Comment and element.text is not None and state.active():
+            self._split_text_node(state, element, element.text, self._targets(state, frame, state.current))
+        return frame
+
+    def _targets(self, state, frame, section):
+        """Return, for each layer, the list that the tokens of an element in the given
+        section go into and where they begin in it, along with the list of tokens
+        that have yet to be given a context and where those of the element begin."""
+        targets = []
+        for layer in range(len(state.layers)):
+            key = (layer, section)
+            tokens, bare = state.touch(frame.found, key, self._plan.context)
+            targets.append((tokens, frame.starts[key], bare, frame.bare_starts.get(key, 0)))
+        return targets
+
+    def _close(self, state, frame):
+        """Finish an element whose children have all been handled, by applying its
+        tag-specific logic and handling its tail."""
+        element, found, options = frame.element, frame.found, frame.options
+        if options is not None and (state.passed != frame.passed or not state.active()):
+            # We went into another section inside the choice, so the options
+            # will have to be tokenized again for the section we ended up in.
+            for child, child_found in options.items():
+                for key, child_tokens in child_found.items():
+                    tokens = state.touch(found, key, self._plan.context)[0]
+                    joint = len(tokens)
+                    tokens.extend(child_tokens)
+                    self._join_child(state, tokens, frame.starts[key], joint, child)
+            options = None
 
         # Now we handle our tag-specific logic, after the child text and child tags
         # have been processed but before the tail is processed.
-        # First, are we in the milestone we want?
-        if _tag_is(element, 'milestone'):
-            if element.get('n') == self.MILESTONE:
-                self.INMILESTONE = True
-            elif self.MILESTONE is not None:
-                self.INMILESTONE = False
-        if not self.INMILESTONE:
-            return tokens
+        # First, are we in a milestone we want?
+        if state.wanted is not None and element.tag == _MILESTONE:
+            state.current = element.get('n')
+            state.passed += 1
+        if not state.active():
+            return
+        section = state.current
+        if options is None and element.tag == _CHOICE:
+            options = {opt: self._find_words(state, opt) for opt in element}
+        targets = self._targets(state, frame, section)
+        for layer, target in enumerate(targets):
+            self._finish_element(state, element, target, section, layer, options)
+        self._finish_tail(state, element, section, targets)
 
-        # Move on with life
+    def _join_child(self, state, tokens, start, joint, child):
+        """Join the first token that a child element added to a list of tokens onto
+        the token before it, if that belongs to the parent (i.e. it comes after
+        start) and the word continues, and if their 'lit' values together still
+        make well-formed XML. The child's tokens begin at joint."""
+        if joint <= start or joint >= len(tokens) or 'continue' not in tokens[joint - 1]:
+            return
+        prior = tokens[joint - 1]
+        if _joins_cleanly(state, prior, tokens[joint]):
+            partial = tokens.pop(joint)
+            prior['t'] += partial['t']
+            prior['n'] += partial['n']
+            # Now figure out 'lit'. Did the child have children?
+            if child.text is None and len(child) == 0:
+                # It's a milestone element. Stick it into 'lit'.
+                prior['lit'] += state.lit(child)
+            prior['lit'] += partial['lit']
+            if id(partial) in state.unsafe:
+                state.unsafe.add(id(prior))
+            if 'continue' not in partial:
+                del prior['continue']
 
+    def _finish_element(self, state, element, target, section, layer, options=None):
+        """Apply the tag-specific logic of an element to the tokens found in it for
+        the layer and section we are in, and set their context. For a <choice>,
+        options holds what was found in each of its children."""
+        tokens, start, bare, bare_start = target
         # Deal with specific tag logic
-        if (_tag_is(element, 'del') and first_layer is False) \
-                or ((_tag_is(element, 'add') or _tag_is(element, 'mod'))
-                    and first_layer is True) or _tag_is(element, 'note') or _tag_is(element, 'fw'):
+        if element.tag in state.layers[layer]:
             # If we are looking at a del tag for the final layer, or an add/mod tag for the
             # first layer, discard all the tokens we just got.
-            tokens = []
-        elif _tag_is(element, 'choice'):
-            # If we are looking at a choice tag, we need to redo the token grabbing separately
+            del tokens[start:]
+        elif element.tag == _CHOICE:
+            # If we are looking at a choice tag, we need the tokens of each option separately
             # for the oppositional pairs. Set sic/orig/abbr to be the t value, and corr/reg/expan
             # to be the n value. We treat this as a single token, since we can't do any sort of
             # reasonable intra-tag correlation of multiple tokens.
-            mytoken = {'lit': tokens_to_string(tokens, field='lit')}
+            # The 'lit' of the token will be the whole element; see below.
+            mytoken = {'lit': None}
             for opt in element:
+                opttokens = options[opt].get((layer, section), [])
                 # If the tag is a corrected/regularized/expanded form, it belongs in the 'normal form' field.
-                if _tag_is(opt, 'corr') or _tag_is(opt, 'reg') or _tag_is(opt, 'expan'):
-                    ccorr = self._find_words(opt, first_layer)
-                    if len(ccorr) > 0:
-                        mytoken['n'] = tokens_to_string(ccorr)
+                if opt.tag in _NORMAL_FORMS:
+                    if len(opttokens) > 0:
+                        mytoken['n'] = tokens_to_string(opttokens)
                 # Otherwise, it belongs in the regular token field.
                 else:
-                   corig = self._find_words(opt, first_layer)
-                   if len(corig) > 0:
-                       mytoken['t'] = tokens_to_string(corig)
-                       if 'continue' in corig[-1]:
+                   if len(opttokens) > 0:
+                       mytoken['t'] = tokens_to_string(opttokens)
+                       if 'continue' in opttokens[-1]:
                            mytoken['continue'] = True
 
             # If we have neither corrected nor uncorrected, just skip this token
             if 't' not in mytoken and 'n' not in mytoken:
-                tokens = []
+                del tokens[start:]
             # If we have a corrected but no original form, set the corrected form to 't'
             elif 't' not in mytoken:
                 mytoken['t'] = mytoken['n']
             elif 'n' not in mytoken:
                 mytoken['n'] = mytoken['t']
-            tokens = [mytoken]
-        elif _tag_is(element, 'num'):
+            tokens[start:] = [mytoken]
+            if bare is not None:
+                bare.append(mytoken)
+        elif element.tag == _NUM:
             # Combine all the word tokens into a single one, and set 'n' to the number value.
+            mine = tokens[start:]
             mytoken = {'n': element.get('value'),
-                       't': tokens_to_string(tokens),
-                       'lit': tokens_to_string(tokens, field='lit')
+                       't': tokens_to_string(mine),
+                       'lit': tokens_to_string(mine, field='lit')
                        }
             # Replicate whatever metadata has been assigned to the first token, apart from
             # joining flags which are a special case.
-            for k in tokens[0]:
+            for k in mine[0]:
                 if k not in mytoken and not k.startswith('join'):
-                    mytoken[k] = tokens[0][k]
+                    mytoken[k] = mine[0][k]
             # Deal with the continue flag if we have one
-            if 'continue' in tokens[-1]:
+            if 'continue' in mine[-1]:
                 mytoken['continue'] = True
             elif 'continue' in mytoken:
                 del mytoken['continue']
             # Deal with the joining flags if we have them
-            if 'join_prior' in tokens[0]:
-                mytoken['join_prior'] = tokens[0]['join_prior']
-            if 'join_next' in tokens[-1]:
-                mytoken['join_next'] = tokens[-1]['join_next']
-            tokens = [mytoken]
+            if 'join_prior' in mine[0]:
+                mytoken['join_prior'] = mine[0]['join_prior']
+            if 'join_next' in mine[-1]:
+                mytoken['join_next'] = mine[-1]['join_next']
+            tokens[start:] = [mytoken]
+            if bare is not None and 'context' not in mytoken:
+                bare.append(mytoken)
 
-        # Now tokens has only the tokenized contents of the element itself.
+        # Now the list has only the tokenized contents of the element itself after start.
         # If there is a single token, then we 'lit' the entire element and will use the
         # parent context below.
         singlewordelement = False
-        if len(tokens) == 1:
-            tokens[0]['lit'] = _shortform(etree.tostring(element, encoding='unicode', with_tail=False))
+        if len(tokens) - start == 1:
+            tokens[start]['lit'] = state.lit(element)
+            _mark_serialized(state, tokens[start])
             singlewordelement = True
 
         # Set the context on all the tokens created thus far
-        parentcontext = _shortform(self.xml_doc.getelementpath(element.getparent()))
+        if not self._plan.context:
+            return
+        parentcontext = state.path(element.getparent())[1]
         if element.tag is etree.Comment:
             context = parentcontext
         else:
-            context = _shortform(self.xml_doc.getelementpath(element))
+            context = state.path(element)[1]
         if singlewordelement:
-            tokens[0]['context'] = parentcontext
-        for t in tokens:
+            tokens[start]['context'] = parentcontext
+        for t in bare[bare_start:]:
             if 'context' not in t:
                 t['context'] = context
+        del bare[bare_start:]
 
-        # Finally handle the tail text of this element, if any.
+    def _finish_tail(self, state, element, section, targets):
+        """Add the tokens of an element's tail to its tokens for each layer."""
         # Our XML context is now the element's parent.
         if element.tail is not None:
             # Strip any insignificant whitespace from the tail.
             tnode = element.tail
-            if re.match('.*\}[clp]b$', str(element.tag)):
-                tnode = re.sub('^[\s\n]*', '', element.tail, re.S)
-            if tnode != '':
-                self._split_text_node(element, tnode, tokens)
+            if _BREAK.match(str(element.tag)):
+                tnode = element.tail.lstrip()
+            # Our section might have ended inside the element.
+            if tnode != '' and state.current == section:
+                self._split_text_node(state, element, tnode, targets)
             # Set the outer context on all the new tokens created
-            for t in tokens:
-                if 'context' not in t:
-                    t['context'] = parentcontext
+            if self._plan.context:
+                parentcontext = state.path(element.getparent())[1]
+                for tokens, start, bare, bare_start in targets:
+                    for t in bare[bare_start:]:
+                        if 'context' not in t:
+                            t['context'] = parentcontext
+                    del bare[bare_start:]
 
         # Get rid of any final empty tokens, if there are preceding tokens.
-        if len(tokens) > 1 and _is_blank(tokens[-1]):
-            tokens.pop()
-        return tokens
+        for tokens, start, bare, bare_start in targets:
+            if len(tokens) - start > 1 and _is_blank(tokens[-1]):
+                tokens.pop()
 
-    def _split_text_node(self, context, tnode, tokens):
-        if not self.INMILESTONE:
-            return tokens
-        tnode = tnode.rstrip('\n')
-        words = re.split('\s+', tnode)
-        # Filter out any blank spaces at the end (but not at the beginning! We may need the
-        # empty token to close out a 'continue' token that ends the outer layer.)
-        join_last = True
-        if words[-1] == '':
-            words.pop()
-            join_last = False
-        # If we are splitting punctuation into separate tokens then we have to iterate through
-        # the words twice in order to do this, and record joining flags as we go.
-        pregexstr = ''
-        pregex = None
-        if self.punctuation:
-            for x in self.punctuation:
-                pregexstr += x
-            pregex = re.compile("([{}]+)?([^{}]+)([{}]+)?".format(pregexstr, pregexstr, pregexstr))
-        tstrings = []
-        for word in words:
-            wtuple = (None, word, None)
-            if self.punctuation:
-                # Make the regex that looks for punctuation.
-                wmatch = pregex.fullmatch(word)
-                if wmatch is not None:
-                    wtuple = wmatch.groups()
-            if wtuple[0] is not None:
-                tstrings.append((wtuple[0], 'join_next'))
-            if wtuple[1] is not None:
-                tstrings.append((wtuple[1], None))
-            if wtuple[2] is not None:
-                tstrings.append((wtuple[2], 'join_prior'))
+    def _split_text_node(self, state, context, tnode, targets):
+        """Split a text node into tokens, and add them to the lists for each layer."""
+        tstrings, join_last = self._plan.lexer.split(tnode)
+        for tokens, start, bare, bare_start in targets:
+            self._add_text_tokens(state, context, tstrings, join_last, tokens, start, bare)
 
+    def _add_text_tokens(self, state, context, tstrings, join_last, tokens, start, bare):
         # Now iterate through the token string tuples, to make the actual tokens.
         for tstr in tstrings:
             word = tstr[0]
             flag = tstr[1]
-            if len(tokens) and 'continue' in tokens[-1]:
+            if len(tokens) > start and 'continue' in tokens[-1]:
                 # If the previous token is flagged as a continuation, we append the first
                 # of our tstrings to it...unless the tstring is punctuation, and that punctuation
                 # should be a separate token!
                 open_token = tokens.pop()
                 new_token = None
-                if flag == 'join_prior' or (pregexstr != '' and re.fullmatch("[{}]".format(pregexstr), word)):
+                if flag == 'join_prior' or self._plan.lexer.is_punctuation(word):
                     # We make a new token.
-                    new_token = _make_token(context, word, 'join_prior')
+                    new_token = _make_token(state.fields(context), word, 'join_prior')
+                    if _unsafe_text(word):
+                        state.unsafe.add(id(new_token))
+                    if bare is not None:
+                        bare.append(new_token)
                 else:
                     # We modify the existing token.
                     open_token['t'] += word
                     open_token['n'] += word
+                    if _unsafe_text(word) or _ends_cdata(open_token['lit'], word):
+                        state.unsafe.add(id(open_token))
                     open_token['lit'] += word
                     if flag is not None:
                         open_token[flag] = True
@@ -311,23 +737,29 @@ class Tokenizer:
                 tokens.append(open_token)
                 if new_token is not None:
                     tokens.append(new_token)
-            elif len(tokens) and word == '':
+            elif len(tokens) > start and word == '':
                 # In this case we can discard any blank-space token at the beginning.
                 continue
             else:
-                token = _make_token(context, word, flag)
+                token = _make_token(state.fields(context), word, flag)
+                if _unsafe_text(word):
+                    state.unsafe.add(id(token))
+                if bare is not None:
+                    bare.append(token)
                 tokens.append(token)
-        if len(tokens) and join_last:
+        if len(tokens) > start and join_last:
             tokens[-1]['continue'] = True
-        return tokens
 
 
-# Helper functions that don't need instance variables #
-# Return the LXML-style element name with namespace
-def _tag_is(el, tag):
-    return el.tag == '{http://www.tei-c.org/ns/1.0}%s' % tag
+# The TEI tags and XPath expressions that the tokenizer looks for
+_CHOICE, _MILESTONE, _NUM, _TEXT = ('{http://www.tei-c.org/ns/1.0}%s' % t for t in ('choice', 'milestone', 'num', 'text'))
+_NORMAL_FORMS = frozenset('{http://www.tei-c.org/ns/1.0}%s' % t for t in ('corr', 'reg', 'expan'))
+_BREAK = re.compile(r'.*\}[clp]b$')
+# The first <text> of the document, which is found without looking through the rest
+_TEXT_XPATH = etree.XPath('/descendant::t:text[1]', namespaces={'t': 'http://www.tei-c.org/ns/1.0'})
 
 
+# Helper functions that don't need instance variables #
 # Return a JSON structure that represents an XML element and attributes
 def _xmljson(el):
     tag = _shortform(el.tag)
@@ -339,48 +771,764 @@ def _xmljson(el):
 
 # Helper function to convert namespaces back to short forms
 def _shortform(xmlstr):
-    nsmap = {
-        'http://www.w3.org/XML/1998/namespace': 'xml',
-        'http://www.tei-c.org/ns/1.0': None
-    }
-
-    for k in nsmap.keys():
-        v = nsmap.get(k)
-        # Undo lxml namespace handling
-        if '{%s}' % k in xmlstr:
-            if v is None:
-                return xmlstr.replace('{%s}' % k, '')
-            else:
-                return xmlstr.replace('{%s}' % k, v + ':')
-        # Undo explicit namespace declaration in string ouptut
-        elif k in xmlstr and v is None:
-            return xmlstr.replace(' xmlns="%s"' % k, '')
+    # Undo lxml namespace handling
+    if '{http://www.w3.org/XML/1998/namespace}' in xmlstr:
+        return xmlstr.replace('{http://www.w3.org/XML/1998/namespace}', 'xml:')
+    if '{http://www.tei-c.org/ns/1.0}' in xmlstr:
+        return xmlstr.replace('{http://www.tei-c.org/ns/1.0}', '')
+    # Undo explicit namespace declaration in string ouptut
+    if 'http://www.tei-c.org/ns/1.0' in xmlstr:
+        return xmlstr.replace(' xmlns="http://www.tei-c.org/ns/1.0"', '')
     return xmlstr
 
 
-def _make_token(context, ttext, flag):
-    ns = {'t': 'http://www.tei-c.org/ns/1.0'}
+def milestone_index(xml_object):
+    """Return a dictionary that maps the n attribute of each <milestone> element
+    in the given document to the list of milestone elements that have it, in
+    document order."""
+    index = {}
+    for milestone in xml_object.getroottree().getroot().iter(_MILESTONE):
+        index.setdefault(milestone.get('n'), []).append(milestone)
+    return index
+
+
+# The location fields that each token carries, and the tags that define them
+LOCATION_FIELDS = ('section', 'paragraph', 'page', 'column', 'line')
+# All the fields that a token can have, apart from its joining flags, which are
+# always kept. A normalisation function sees only the fields that were asked for,
+# apart from 't' and 'n'.
+TOKEN_FIELDS = ('t', 'n', 'lit', 'context') + LOCATION_FIELDS
+_CONTAINER_TAGS = ('div', 'p')
+_MARKER_TAGS = ('pb', 'cb', 'lb')
+
+
+class _Locations:
+    """The locations of the nodes of a document: for each node, a tuple of the
+    elements that define its location, in the order of LOCATION_FIELDS. They are
+    worked out only for the parts of the document that we come to, by walking it
+    in document order from the first block that we seek, with a _Locator that is
+    started off where it would be had it walked the document from its root."""
+
+    def __init__(self):
+        self.known = {}
+        self.walk = None
+
+    def __getitem__(self, node):
+        while node not in self.known:
+            if next(self.walk, None) is None:
+                raise KeyError(node)
+        return self.known[node]
+
+    def seek(self, node, follows=True, locator=None):
+        """Get ready to be asked about the given node, and what comes after it.
+        If the node follows on from what we have been asked about so far (i.e.
+        nothing much lies between them), we walk on to it; otherwise we start
+        walking afresh from there, with the given _Locator if there is one."""
+        if node in self.known or (follows and self.walk is not None):
+            return
+        self.walk = self._walk(node, _Locator.at(node) if locator is None else locator)
+
+    def _walk(self, node, locator):
+        for event, found in _walk_from(node):
+            if event == 'end':
+                locator.end(found)
+            else:
+                self.known[found] = locator.start(found)
+            yield True
+
+
+def _walk_from(node):
+    """Yield the events that iterwalk gives for the document, from the start of the
+    given element to the end of the document."""
+    events = ('start', 'end', 'comment', 'pi')
+    yield from etree.iterwalk(node, events=events)
+    parent = node.getparent()
+    while parent is not None:
+        for sibling in node.itersiblings():
+            if isinstance(sibling.tag, str):
+                yield from etree.iterwalk(sibling, events=events)
+            else:
+                # A comment, processing instruction or entity, which iterwalk
+                # won't start from
+                yield 'start', sibling
+        yield 'end', parent
+        node = parent
+        parent = node.getparent()
+
+
+def _preceding(node, tag, earlier=None):
+    """Return the last element with the given tag that comes before the given node
+    in the document, apart from those that the node is inside of; or None. If some
+    element before the node is given, as the set of it and its ancestors, we look
+    back no further than where it starts, and return False if there is nothing
+    between there and the node."""
+    while node is not None:
+        for sibling in node.itersiblings(preceding=True):
+            found = None
+            for found in sibling.iter(tag):
+                pass
+            if found is not None:
+                return found
+            if earlier is not None and sibling in earlier:
+                return False
+        node = node.getparent()
+        if earlier is not None and node in earlier:
+            return False
+    return None
+
+
+class _Plan:
+    """What a tokenizer does with every document, worked out once from its
+    configuration: the compiled XPath expressions, the lexer for text nodes, the
+    tags whose tokens are left out of the layer we want, the normalisation, and
+    which of the token fields have to be worked out."""
+
+    def __init__(self, first_layer=False, punctuation=None, normalisation=None, id_xpath=None, block_xpath=None,
+                 fields=None):
+        self.config = (first_layer, punctuation, normalisation, id_xpath, block_xpath, fields)
+        ns = {'t': 'http://www.tei-c.org/ns/1.0'}
+        self.sigil = None if id_xpath is None else etree.XPath(id_xpath, namespaces=ns)
+        self.blocks = etree.XPath(block_xpath, namespaces=ns)
+        self.lexer = _Lexer(punctuation)
+        self.normalisation = normalisation
+        # A normalisation that can work on many tokens at once
+        batched = isinstance(normalisation, (Normaliser, BatchNormaliser))
+        self.batch = normalisation.batch if batched else None
+        # Whether the normalisation is handed the tokens themselves (rather than
+        # only, say, their 'n' values), and so might change their location fields
+        self.sees_tokens = normalisation is not None and not isinstance(normalisation, Normaliser) \
+            and not (isinstance(normalisation, BatchNormaliser) and normalisation.column is not None)
+        self.discard = _discarded(first_layer)
+        # The final and the first layer, for when we want both.
+        self.both = (_discarded(False), _discarded(True))
+        if fields is None:
+            fields = TOKEN_FIELDS
+        unknown = set(fields) - set(TOKEN_FIELDS)
+        if len(unknown):
+            raise ValueError("Unknown token field(s): %s" % ', '.join(sorted(unknown)))
+        # The 't', 'n' and 'lit' fields are needed to put the tokens together, so
+        # they are always there until the end; a 'lit' that isn't wanted is only
+        # a stand-in for the serialized elements, though.
+        self.lit = 'lit' in fields
+        self.context = 'context' in fields
+        self.locations = tuple(f for f in LOCATION_FIELDS if f in fields)
+        self.dropped = tuple(f for f in ('t', 'n', 'lit') if f not in fields)
+        # What the normalisation shouldn't see, since it isn't what it seems
+        self.hidden = tuple(f for f in self.dropped if f not in ('t', 'n'))
+
+    def __reduce__(self):
+        # Compiled XPath expressions can't be pickled, so compile them anew.
+        return _Plan, self.config
+
+
+def _discarded(first_layer):
+    """Return the tags whose tokens are left out of the final layer of the text
+    (if first_layer is False) or the first layer (if first_layer is True)."""
+    discard = ['note', 'fw']
+    if first_layer is False:
+        discard.append('del')
+    elif first_layer is True:
+        discard.extend(['add', 'mod'])
+    return frozenset('{http://www.tei-c.org/ns/1.0}%s' % t for t in discard)
+
+
+class _Lexer:
+    """Splits a text node into words, and the words into punctuation and the rest,
+    with regular expressions that are compiled once for a tokenizer."""
+
+    def __init__(self, punctuation=None):
+        self.punctuation = None
+        # Whitespace can't be punctuation, since it is what separates the words.
+        pclass = ''.join(re.escape(c) for c in ''.join(punctuation or []) if not c.isspace())
+        if pclass:
+            # A word is either some non-punctuation with punctuation on either side
+            # of it, which is split off, or else it is left as it is.
+            self.words = re.compile(r'(?<!\S)(?:([{0}]+)?([^{0}\s]+)([{0}]+)?(?!\S)|\S+)'.format(pclass))
+            self.punctuation = re.compile('[{}]'.format(pclass))
+        else:
+            self.words = re.compile(r'\S+')
+
+    def split(self, text):
+        """Return the strings in the text that should be tokens, each with the joining
+        flag it needs, and whether the last of them runs on into what follows."""
+        text = text.rstrip('\n')
+        if text == '':
+            return [], False
+        tstrings = []
+        # Keep an empty string for any blank space at the beginning, since we may
+        # need the empty token to close out a 'continue' token that ends the outer
+        # layer.
+        if text[0].isspace():
+            tstrings.append(('', None))
+        if self.punctuation is None:
+            tstrings.extend((m.group(), None) for m in self.words.finditer(text))
+        else:
+            for m in self.words.finditer(text):
+                before, word, after = m.groups()
+                if word is None:
+                    tstrings.append((m.group(), None))
+                    continue
+                if before is not None:
+                    tstrings.append((before, 'join_next'))
+                tstrings.append((word, None))
+                if after is not None:
+                    tstrings.append((after, 'join_prior'))
+        return tstrings, not text[-1].isspace()
+
+    def is_punctuation(self, word):
+        """Return True if the word is a single punctuation character."""
+        return self.punctuation is not None and self.punctuation.fullmatch(word) is not None
+
+
+class _DocumentState:
+    """The state of a single tokenizer call: where each node of the document is,
+    the element paths we have worked out, and which milestone section we are in."""
+
+    def __init__(self, root, locations, wanted, layers, index=None, lit=True, location_fields=LOCATION_FIELDS):
+        self.root = root
+        self.locations = locations
+        # Whether we want the real 'lit' values, and which of the location fields.
+        self.want_lit = lit
+        self.location_fields = location_fields
+        self.paths = {}
+        # The location records of the elements that tokens have been found in,
+        # and the location fields for the last location we looked up.
+        self.records = {}
+        self.last_location = (None, ())
+        # The tokens (by id) whose 'lit' might not be well-formed XML, because it
+        # has text with markup characters in it.
+        self.unsafe = set()
+        # The serialized forms of the elements we have needed as 'lit' values.
+        self.lits = {}
+        # For each layer and section, the tokens that have yet to be given a context,
+        # in the order they were made.
+        self.bare = {}
+        # The elements that we are in the middle of, innermost last.
+        self.frames = []
+        # The milestones whose sections we want (None for the whole text), and the
+        # one we are in. If we have the milestone index, we also note which elements
+        # hold milestones that we want, so that anything else can be skipped while
+        # we are outside those sections.
+        self.wanted = None if wanted is None else set(wanted)
+        self.current = None
+        # For each layer of the text that we want, the tags whose tokens it leaves out.
+        self.layers = layers
+        self.passed = 0
+        self.within = None
+        if self.wanted is not None and index is not None:
+            self.within = set()
+            for n in self.wanted:
+                for milestone in index.get(n, []):
+                    self.within.add(milestone)
+                    self.within.update(milestone.iterancestors())
+
+    def active(self):
+        """Return True if we are in a section that we want."""
+        return self.wanted is None or self.current in self.wanted
+
+    def touch(self, found, key, bare=True):
+        """Return the list of tokens for the given key (layer and section) in found,
+        and the list of its tokens that have yet to be given a context (if bare is
+        set), before anything is added to them or taken from them. Every element
+        that we are in the middle of notes where its own tokens begin in them, if it
+        hasn't done so already; nothing has been done to them since it began, or it
+        would have. Whenever an element has noted this, so have those it is in."""
+        tokens = found.setdefault(key, [])
+        pending = self.bare.setdefault(key, []) if bare else None
+        for frame in reversed(self.frames):
+            # The elements with tokens in found are the innermost ones.
+            mine = frame.found is found
+            if (not mine or key in frame.starts) and (not bare or key in frame.bare_starts):
+                break
+            if mine and key not in frame.starts:
+                frame.starts[key] = len(tokens)
+            if bare and key not in frame.bare_starts:
+                frame.bare_starts[key] = len(pending)
+        return tokens, pending
+
+    def skippable(self, element):
+        """Return True if the element can yield no tokens for a section that we
+        want, i.e. if we are outside those sections and none of them starts in it."""
+        return self.within is not None and not self.active() and element not in self.within
+
+    def path(self, element):
+        """Return the element path of the given element, relative to the root of
+        the document we are tokenizing, as a tuple of its full and short forms.
+        This matches what getelementpath would give, but each path is built
+        once from the path of its parent and then cached."""
+        if element not in self.paths:
+            if not isinstance(element.tag, str):
+                raise ValueError("input is not an Element")
+            # Go up to the nearest ancestor whose path we have, and then work
+            # our way back down.
+            parents = []
+            node = element
+            while node not in self.paths:
+                if node is self.root:
+                    self.paths[node] = ('.', '.')
+                    break
+                node = node.getparent()
+                if node is None:
+                    raise ValueError("Element is not a child of this node.")
+                parents.append(node)
+            # Work out the paths of all of each parent's children at once,
+            # so that we only have to count same-named siblings once.
+            for parent in reversed(parents):
+                for child, step in _path_steps(parent):
+                    self.paths[child] = _child_path(self.paths[parent], step)
+        return self.paths[element]
+
+    def lit(self, element):
+        """Return the serialized form of the given element without namespaces,
+        as _shortform would give it. Each element is serialized only once, and
+        an element whose children have already been serialized is put together
+        from their serialized forms where the namespaces allow it.
+
+        If the 'lit' values aren't wanted, a stand-in is returned instead, which
+        works as well as the real thing for joining the tokens; only an element
+        with unresolved entities in it, which might not join cleanly, is
+        serialized all the same."""
+        if not self.want_lit and next(element.iter(etree.Entity), None) is None:
+            return _STAND_IN
+        if element not in self.lits:
+            self.lits[element] = _serialize(element, self.lits)
+        return self.lits[element][0]
+
+    def fields(self, node):
+        """Return the location fields for the tokens found at the given node, as
+        pairs of field name and record. There is one record for each element, which
+        all the tokens located there share."""
+        if not len(self.location_fields):
+            return ()
+        location = self.locations[node]
+        if location is not self.last_location[0]:
+            fields = []
+            for k, el in zip(LOCATION_FIELDS, location):
+                if el is not None and k in self.location_fields:
+                    if el not in self.records:
+                        self.records[el] = _Record(_xmljson(el).get('attr'))
+                    fields.append((k, self.records[el]))
+            self.last_location = (location, tuple(fields))
+        return self.last_location[1]
+
+    def release(self, element, keep=False):
+        """Free the memory used by a streamed element and everything before it,
+        unless keep is set, in which case only what precedes the element goes."""
+        if not keep:
+            for node in element.iter():
+                self.locations.pop(node, None)
+                self.paths.pop(node, None)
+                self.lits.pop(node, None)
+                self.records.pop(node, None)
+            # Page, column and line markers might still be needed for the location
+            # of later tokens, so keep their attributes.
+            if _localname(element) not in _MARKER_TAGS:
+                element.clear()
+        parent = element.getparent()
+        while parent is not None and element.getprevious() is not None:
+            for node in parent[0].iter():
+                self.locations.pop(node, None)
+                self.paths.pop(node, None)
+                self.lits.pop(node, None)
+                self.records.pop(node, None)
+            del parent[0]
+
+
+class _Locator:
+    """Keep track of where we are in a document whose nodes are visited in
+    document order. Sections and paragraphs are the nearest enclosing div and p;
+    pages, columns and lines are the nearest preceding pb, cb and lb. A node that
+    is itself one of these elements is its own location."""
+
+    def __init__(self):
+        self.containers = {t: [] for t in _CONTAINER_TAGS}
+        # For each marker, the (start position, element) of the latest-starting
+        # marker element that has already been closed.
+        self.markers = {t: (-1, None) for t in _MARKER_TAGS}
+        self.started = {}
+        self.position = 0
+
+    @classmethod
+    def at(cls, node, since=None):
+        """Return a _Locator that is where one that had walked the document from
+        its root would be, just before the given element starts. If we have done
+        this for an element before it, that element and its _Locator can be given
+        as 'since', so that we needn't look back any further than that."""
+        locator = cls()
+        ancestors = list(node.iterancestors())[::-1]
+        earlier = None
+        if since is not None:
+            earlier = set(since[0].iterancestors())
+            earlier.add(since[0])
+        for el in ancestors:
+            if _localname(el) in locator.containers:
+                locator.containers[_localname(el)].append(el)
+        # The markers that have closed before the node, and those that it is
+        # inside of, all come before anything we go on to see, but among
+        # themselves they have to be kept in the order they started in.
+        for t in _MARKER_TAGS:
+            tag = '{http://www.tei-c.org/ns/1.0}' + t
+            order = [el for el in ancestors if el.tag == tag]
+            marker = _preceding(node, tag, earlier)
+            if marker is False:
+                marker = since[1].markers[t][1]
+            if marker is not None:
+                outer = set(marker.iterancestors())
+                order.insert(sum(1 for el in order if el in outer), marker)
+            locator.markers[t] = (-len(order) - 1, None)
+            for position, el in enumerate(order, -len(order)):
+                if el is marker:
+                    locator.markers[t] = (position, el)
+                else:
+                    locator.started[el] = position
+        return locator
+
+    @classmethod
+    def placed(cls, location):
+        """Return a _Locator that is in the given location (the elements that define
+        it, in the order of LOCATION_FIELDS), as if just before an element starts, for
+        when the rest of the document isn't there to be looked at."""
+        locator = cls()
+        for t, el in zip(_CONTAINER_TAGS + _MARKER_TAGS, location):
+            if el is None:
+                continue
+            if t in locator.containers:
+                locator.containers[t].append(el)
+            else:
+                locator.markers[t] = (-1, el)
+        return locator
+
+    def location(self):
+        """Return the location that a node which starts now would have, if it
+        isn't one of the elements that define locations itself."""
+        containers = [self.containers[t][-1] if len(self.containers[t]) else None for t in _CONTAINER_TAGS]
+        return tuple(containers) + tuple(self.markers[t][1] for t in _MARKER_TAGS)
+
+    def start(self, node):
+        """Return the location of an element that is opening, or of a comment or
+        processing instruction."""
+        tag = _localname(node)
+        location = []
+        for t in _CONTAINER_TAGS:
+            if tag == t:
+                location.append(node)
+            elif len(self.containers[t]):
+                location.append(self.containers[t][-1])
+            else:
+                location.append(None)
+        for t in _MARKER_TAGS:
+            location.append(node if tag == t else self.markers[t][1])
+        if tag in self.containers:
+            self.containers[tag].append(node)
+        elif tag in self.markers:
+            self.started[node] = self.position
+        self.position += 1
+        return tuple(location)
+
+    def end(self, node):
+        """Note that an element has closed."""
+        tag = _localname(node)
+        if tag in self.containers:
+            self.containers[tag].pop()
+        elif tag in self.markers:
+            position = self.started.pop(node)
+            if position > self.markers[tag][0]:
+                self.markers[tag] = (position, node)
+
+
+class _BlockFinder:
+    """Look for the blocks of a text that is still being parsed. The parser reads
+    ahead of the events it has given us, so rather than evaluate the block XPath
+    each time we need to know about an element, we evaluate it once for all that
+    has been parsed, and again only when we are asked about elements that have
+    been parsed since."""
+
+    def __init__(self, thetext, xpath):
+        self.thetext = thetext
+        self.xpath = xpath
+        self.blocks = []
+        self.parsed = set()
+
+    def is_block(self, element):
+        self._refresh([element])
+        return element in self.blocks
+
+    def inner(self, block):
+        """Return the blocks inside the given (finished) block, in document order."""
+        self._refresh(block.iterdescendants())
+        if block not in self.blocks:
+            return []
+        # Blocks come in document order, so any inside this one come right after it.
+        found = []
+        for other in self.blocks[self.blocks.index(block) + 1:]:
+            if block not in other.iterancestors():
+                break
+            found.append(other)
+        return found
+
+    def _refresh(self, elements):
+        for el in elements:
+            if el not in self.parsed:
+                self.blocks = self.xpath(self.thetext)
+                self.parsed = set(self.thetext.iter())
+                break
+
+
+def _repeated_tags(source, encoding=None):
+    """Read through a document and return a dictionary that maps the ordinal of
+    each element (counted in document order) to the set of tags that occur more
+    than once among its children, for those elements that have any."""
+    repeats = {}
+    stack = []
+    ordinal = 0
+    for event, node in etree.iterparse(source, events=('start', 'end'), encoding=encoding):
+        if event == 'start':
+            if len(stack):
+                seen = stack[-1][1]
+                seen[node.tag] = seen.get(node.tag, 0) + 1
+            stack.append((ordinal, {}))
+            ordinal += 1
+        else:
+            element_ordinal, seen = stack.pop()
+            repeated = set(t for t, c in seen.items() if c > 1)
+            if len(repeated):
+                repeats[element_ordinal] = repeated
+            node.clear()
+            parent = node.getparent()
+            while parent is not None and node.getprevious() is not None:
+                del parent[0]
+    return repeats
+
+
+# Return the local name of a TEI element, or None if it is not a TEI element
+def _localname(el):
+    if isinstance(el.tag, str) and el.tag.startswith('{http://www.tei-c.org/ns/1.0}'):
+        return el.tag[29:]
+    return None
+
+
+def _child_path(parentpaths, step):
+    """Return the full and short forms of the element path of a child, given
+    those of its parent and the step from the parent to the child."""
+    parentpath, parentshort = parentpaths
+    if parentpath == '.':
+        return step, _shortform(step)
+    path = parentpath + '/' + step
+    if '{http://www.w3.org/XML/1998/namespace}' in path:
+        # _shortform treats a path with this namespace in it differently, so
+        # it has to be given the whole path.
+        return path, _shortform(path)
+    return path, parentshort + '/' + _shortform(step)
+
+
+def _path_steps(parent):
+    """Return (child, path step) pairs for the element children of the given
+    element, where each step is the child's tag, followed by its position among
+    its like-named siblings if it has any, in the manner of getelementpath."""
+    children = [c for c in parent if isinstance(c.tag, str)]
+    total = {}
+    for c in children:
+        total[c.tag] = total.get(c.tag, 0) + 1
+    seen = {}
+    steps = []
+    for c in children:
+        step = c.tag
+        if total[c.tag] > 1:
+            seen[c.tag] = seen.get(c.tag, 0) + 1
+            step += '[%d]' % seen[c.tag]
+        steps.append((c, step))
+    return steps
+
+
+# What stands in for a serialized element when the 'lit' values are not wanted.
+# Like any serialized element, it is balanced, and begins with '<' and ends
+# with '>', so it joins onto other 'lit' values in the same way.
+_STAND_IN = '<_/>'
+
+# Entity or character references that can be in serialized XML; anything
+# else after an ampersand is an entity the 'lit' string can't be parsed with.
+_XML_ESCAPE = re.compile(r'&(?!(?:amp|lt|gt|quot|apos|#[0-9]+|#x[0-9a-fA-F]+);)')
+
+
+def _unsafe_text(word):
+    """Return True if the raw text would not be well-formed as XML content."""
+    return '<' in word or '&' in word or ']]>' in word
+
+
+def _ends_cdata(first, second):
+    """Return True if joining two strings would make a ']]>' across the join."""
+    return ']]>' in first[-2:] + second[:2]
+
+
+def _mark_serialized(state, token):
+    """Note whether a token whose 'lit' is now a serialized element can be
+    parsed, which it can unless the element held unresolved entities."""
+    if '&' in token['lit'] and _XML_ESCAPE.search(token['lit']):
+        state.unsafe.add(id(token))
+    else:
+        state.unsafe.discard(id(token))
+
+
+def _joins_cleanly(state, prior, token):
+    """Return True if the 'lit' values of the two tokens make well-formed XML
+    when put together. Serialized elements are always balanced, so unless one
+    of the tokens has text with markup characters in it, only a CDATA end
+    marker across the join can stop them from being well-formed; otherwise
+    we have to try to parse them."""
+    if id(prior) not in state.unsafe and id(token) not in state.unsafe:
+        return not _ends_cdata(prior['lit'], token['lit'])
+    try:
+        etree.fromstring("<word>%s</word>" % (prior['lit'] + token['lit']))
+    except etree.XMLSyntaxError:
+        return False
+    return True
+
+
+def _escape(text, attribute=False):
+    """Escape text or an attribute value the way lxml does when serializing."""
+    if '&' in text:
+        text = text.replace('&', '&amp;')
+    if '<' in text:
+        text = text.replace('<', '&lt;')
+    if '>' in text:
+        text = text.replace('>', '&gt;')
+    if '\r' in text:
+        text = text.replace('\r', '&#13;')
+    if attribute:
+        if '"' in text:
+            text = text.replace('"', '&quot;')
+        if '\n' in text:
+            text = text.replace('\n', '&#10;')
+        if '\t' in text:
+            text = text.replace('\t', '&#9;')
+    return text
+
+
+def _serialize(node, lits):
+    """Serialize a node without namespaces, as _shortform would. Returns the
+    string, along with whether it is also what the node looks like inside the
+    serialized form of its parent, i.e. whether it needed no namespace
+    declarations apart from the TEI one."""
+    children = [c for c in node if isinstance(c.tag, str)]
+    if children and all(lits.get(c, (None, False))[1] for c in children) \
+            and node.prefix is None and node.tag.startswith('{http://www.tei-c.org/ns/1.0}') \
+            and node.nsmap == {None: 'http://www.tei-c.org/ns/1.0'}:
+        # Put the element together from the serialized forms of its children.
+        name = node.tag[29:]
+        parts = ['<', name]
+        for k, v in node.items():
+            if k.startswith('{http://www.w3.org/XML/1998/namespace}'):
+                k = 'xml:' + k[38:]
+            parts.append(' %s="%s"' % (k, _escape(v, attribute=True)))
+        parts.append('>')
+        if node.text:
+            parts.append(_escape(node.text))
+        for child in node:
+            if isinstance(child.tag, str):
+                parts.append(lits[child][0])
+            else:
+                parts.append(etree.tostring(child, encoding='unicode', with_tail=False))
+            if child.tail:
+                parts.append(_escape(child.tail))
+        parts.append('</%s>' % name)
+        xmlstr = ''.join(parts)
+        if 'http://www.tei-c.org/ns/1.0' not in xmlstr and 'http://www.w3.org/XML/1998/namespace' not in xmlstr:
+            return xmlstr, True
+    xmlstr = _shortform(etree.tostring(node, encoding='unicode', with_tail=False))
+    return xmlstr, 'xmlns' not in xmlstr and 'http://www.tei-c.org/ns/1.0' not in xmlstr \
+        and 'http://www.w3.org/XML/1998/namespace' not in xmlstr
+
+
+def _make_token(fields, ttext, flag):
     token = {'t': ttext, 'n': ttext, 'lit': ttext}
     if flag is not None:
         token[flag] = True
     # Put the word location into the token
-    divisions = {
-        'section': ('./ancestor::t:div', 'div'),
-        'paragraph': ('./ancestor::t:p', 'p'),
-        'page': ('./preceding::t:pb[1]', 'pb'),
-        'column': ('./preceding::t:cb[1]', 'cb'),
-        'line': ('./preceding::t:lb[1]', 'lb')
-    }
-    for k in divisions.keys():
-        xmlpath = divisions.get(k)
-        mydiv = context.xpath(xmlpath[0], namespaces=ns)
-        if _tag_is(context, xmlpath[1]):
-            token[k] = _xmljson(context).get('attr')
-        elif len(mydiv):
-            token[k] = _xmljson(mydiv[-1]).get('attr')
+    token.update(fields)
     return token
 
 
+class _Frame:
+    """An element that the tokenizer is in the middle of: the lists its tokens go
+    into, what is left of its children, what was found in each of them if it is a
+    <choice>, and how many milestones had been passed when it began. Where its
+    tokens begin in each list, and in the lists of tokens that have no context yet,
+    is only noted once the list is touched (see _DocumentState.touch), so that an
+    element need not note it for every section that has been found so far."""
+
+    __slots__ = ('element', 'found', 'starts', 'bare_starts', 'children', 'options', 'passed')
+
+    def __init__(self, element, found, passed):
+        self.element = element
+        self.found = found
+        self.starts = {}
+        self.bare_starts = {}
+        self.children = iter(element)
+        self.options = {} if element.tag == _CHOICE else None
+        self.passed = passed
+
+
+class _Record(dict):
+    """The attributes of the element that a token is located in. A record is shared
+    by all the tokens in its element, so it can't be changed in place; a normalisation
+    function is given plain copies instead (see _detach)."""
+
+    __slots__ = ()
+
+    def _readonly(self, *args, **kwargs):
+        raise TypeError("token location records are shared and cannot be changed")
+
+    __setitem__ = __delitem__ = __ior__ = clear = pop = popitem = setdefault = update = _readonly
+
+    def __reduce__(self):
+        return _Record, (dict(self),)
+
+
+def _detach(token):
+    """Give a token its own plain copies of its location records, so that a
+    normalisation function can change them as it likes. Returns the records that
+    were copied."""
+    records = []
+    for field in LOCATION_FIELDS:
+        record = token.get(field)
+        if type(record) is _Record:
+            token[field] = dict(record)
+            records.append((field, record))
+    return records
+
+
+def _reattach(token, records):
+    """Put back the shared records of a normalised token, wherever its copies
+    are still the same as they were; the ones that were changed become records
+    of their own."""
+    for field, record in records:
+        value = token.get(field)
+        if value == record:
+            token[field] = record
+        elif type(value) is dict:
+            token[field] = _Record(value)
+
+
+def _share_records(witness, records):
+    """Make the location fields of the tokens of a witness that was read back
+    from the witness cache into records again, as they were when it was first
+    tokenized. Equal records are shared, by way of the given dictionary."""
+    for token in witness['tokens']:
+        for field in LOCATION_FIELDS:
+            value = token.get(field)
+            if type(value) is dict:
+                try:
+                    key = tuple(value.items())
+                    record = records.get(key)
+                except TypeError:  # A value that a normalisation put there
+                    key = record = None
+                if record is None:
+                    record = _Record(value)
+                    if key is not None:
+                        records[key] = record
+                token[field] = record
+
+
 # Check to see if a token counts as blank
 def _is_blank(token):
     if token['n'] != '':
@@ -404,19 +1552,402 @@ def tokens_to_string(tokenlist, field="t"):
     return tstr
 
 
+class Normaliser:
+    r"""A normalisation of the 'n' values of tokens, described by what it does rather
+    than as a function, so that it can be compiled into a translation table and a
+    single regular expression. It can be given as the normalisation option of a
+    Tokenizer, or called on a single token like a normalisation function. Given
+    many tokens at once, it works on all of their strings together.
+
+    * lowercase: Put the string into lower case first.
+    * replace: A dictionary of strings and what to replace them with. Strings of more than
+      one character are replaced first, the longest first, and then single characters.
+    * remove: A regular expression for a single character that should be taken out of
+      the string, e.g. r'\W'. This is done along with the replacement of longer strings,
+      which takes precedence.
+    * keep_given: Leave alone the tokens whose 'n' is not their 't', i.e. those for which
+      the text already gives a normal form.
+    """
+
+    def __init__(self, lowercase=False, replace=None, remove=None, keep_given=False):
+        self.lowercase = lowercase
+        self.replace = dict(replace or {})
+        self.remove = remove
+        self.keep_given = keep_given
+        self.table = {ord(k): v for k, v in self.replace.items() if len(k) == 1}
+        self.strings = {k: v for k, v in self.replace.items() if len(k) > 1}
+        alternatives = [re.escape(k) for k in sorted(self.strings, key=len, reverse=True)]
+        if remove is not None:
+            # Never take out the character that separates the strings we are
+            # working on together.
+            alternatives.append('(?:%s)(?<!\x00)' % remove)
+        self.pattern = re.compile('|'.join(alternatives)) if len(alternatives) else None
+
+    def _substitute(self, match):
+        return self.strings.get(match.group(), '')
+
+    def normalise(self, string):
+        """Return the normal form of a string."""
+        if self.lowercase:
+            string = string.lower()
+        if self.pattern is not None:
+            string = self.pattern.sub(self._substitute if self.strings else '', string)
+        if self.table:
+            string = string.translate(self.table)
+        return string
+
+    def normalise_all(self, strings):
+        """Return the normal forms of a list of strings. They are normalised together,
+        as a single string, which saves going through them one by one."""
+        # No string from an XML document can have a NUL character in it.
+        normal = self.normalise('\x00'.join(strings)).split('\x00')
+        if len(normal) != len(strings):
+            # A replacement put a NUL character in.
+            normal = [self.normalise(s) for s in strings]
+        return normal
+
+    def batch(self, tokens):
+        """Normalise a list of tokens in place, and return it."""
+        if self.keep_given:
+            todo = [t for t in tokens if t['n'] == t['t']]
+        else:
+            todo = tokens
+        for token, normal in zip(todo, self.normalise_all([t['n'] for t in todo])):
+            token['n'] = normal
+        return tokens
+
+    def __call__(self, token):
+        return self.batch([token])[0]
+
+
+class BlockCache:
+    """The raw tokens found in the blocks of the documents that a Tokenizer has read,
+    for it to use again when it reads a block that hasn't changed since. The tokens are
+    kept under a hash of everything they depend on, so that a block is found again only
+    if the result of tokenizing it would be the same; if a line number or a milestone
+    before the block has changed, for example, it is tokenized anew.
+
+    At most max_blocks blocks are kept, if it is given; the ones that have gone unused the
+    longest make way for new ones. The cache can be saved to a file with save(), and read
+    back in with BlockCache.load(), for the next time the documents are tokenized. It is
+    not used when the blocks of a document are tokenized in parallel."""
+
+    def __init__(self, max_blocks=None):
+        self.max_blocks = max_blocks
+        self.blocks = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.blocks)
+
+    def get(self, digest):
+        """Return a copy of the tokens found in the block with the given hash, keyed on
+        layer and section, along with the section that the block ends in; or None if
+        we don't have them."""
+        if digest not in self.blocks:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.blocks.move_to_end(digest)
+        found, current = self.blocks[digest]
+        return _copy_found(found), current
+
+    def put(self, digest, found, current):
+        """Keep a copy of the tokens found in a block, and the section it ends in."""
+        self.blocks[digest] = (_copy_found(found), current)
+        self.blocks.move_to_end(digest)
+        if self.max_blocks is not None:
+            while len(self.blocks) > self.max_blocks:
+                self.blocks.popitem(last=False)
+
+    def clear(self):
+        self.blocks.clear()
+
+    def save(self, filename):
+        with open(filename, 'wb') as fh:
+            pickle.dump((self.max_blocks, self.blocks), fh, protocol=pickle.HIGHEST_PROTOCOL)
+
+    @classmethod
+    def load(cls, filename):
+        with open(filename, 'rb') as fh:
+            max_blocks, blocks = pickle.load(fh)
+        cache = cls(max_blocks)
+        cache.blocks = blocks
+        return cache
+
+
+class WitnessCache:
+    """The results of tokenizing whole documents, kept in files in the given directory
+    under a hash of the document and the options of the Tokenizer, so that they can be
+    had again without tokenizing the document. Each result is kept as compressed JSON.
+
+    The results of from_file, from_fh, from_string, from_etree and from_element are
+    kept. A Normaliser is known to the cache by its settings; any other normalisation
+    is cached only if it has a cache_key attribute (or is a BatchNormaliser whose
+    function has one), which should change whenever what the normalisation does
+    changes. Without one, the results are not cached at all.
+
+    If max_bytes is given, the results that have gone unused the longest are removed
+    whenever the files take up more than that. The number of results found in the
+    cache and not found there are counted in hits and misses."""
+
+    # Change this when the tokenizer changes what it gives for a document, so that
+    # what was kept from before is no longer used.
+    VERSION = 1
+    SUFFIX = '.json.z'
+
+    def __init__(self, directory, max_bytes=None):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def fetch(self, digest, tokenize):
+        """Return the result kept under the given hash, or else call tokenize to
+        get it, and keep that."""
+        filename = os.path.join(self.directory, digest + self.SUFFIX)
+        try:
+            with open(filename, 'rb') as fh:
+                result = json.loads(zlib.decompress(fh.read()).decode('utf-8'))
+        except (OSError, ValueError, zlib.error):
+            self.misses += 1
+            result = tokenize()
+            self._store(filename, result)
+            return result
+        self.hits += 1
+        # Note that the result has been used, for the sake of eviction.
+        os.utime(filename)
+        # A pair of results for both layers comes back as a list.
+        records = {}
+        for witness in result if isinstance(result, list) else [result]:
+            _share_records(witness, records)
+        return tuple(result) if isinstance(result, list) else result
+
+    def _store(self, filename, result):
+        data = zlib.compress(json.dumps(result, ensure_ascii=False, separators=(',', ':')).encode('utf-8'))
+        # Write to a temporary file first, so that another process never sees a
+        # half-written result.
+        fd, tmpname = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as fh:
+            fh.write(data)
+        os.replace(tmpname, filename)
+        if self.max_bytes is not None:
+            self.evict(self.max_bytes)
+
+    def _entries(self):
+        """Return (last use, size, filename) for each result that is kept."""
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith(self.SUFFIX):
+                filename = os.path.join(self.directory, name)
+                try:
+                    st = os.stat(filename)
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, filename))
+        return entries
+
+    def size(self):
+        """Return the number of bytes taken up by the results that are kept."""
+        return sum(size for _, size, _ in self._entries())
+
+    def evict(self, max_bytes):
+        """Remove the results that have gone unused the longest, until the rest
+        take up no more than max_bytes."""
+        entries = sorted(self._entries())
+        total = sum(size for _, size, _ in entries)
+        for _, size, filename in entries:
+            if total <= max_bytes:
+                break
+            try:
+                os.remove(filename)
+            except OSError:
+                pass
+            total -= size
+
+    def clear(self):
+        self.evict(0)
+
+    def stats(self):
+        """Return the hits, the misses, and the number and size of the results kept."""
+        entries = self._entries()
+        return {'hits': self.hits, 'misses': self.misses, 'entries': len(entries),
+                'bytes': sum(size for _, size, _ in entries)}
+
+
+class _Unidentifiable(Exception):
+    """Raised when a normalisation has nothing for the witness cache to know it by."""
+
+
+def _identity(normalisation):
+    """Return a string that tells one normalisation from another, for the witness
+    cache: the settings of a Normaliser, the cache_key that the caller has given a
+    normalisation of their own (along with its module and name), or the function
+    and column of a BatchNormaliser. Raises _Unidentifiable if there is none of
+    these to go by."""
+    if normalisation is None:
+        return None
+    if isinstance(normalisation, Normaliser):
+        return repr(('Normaliser', normalisation.lowercase, sorted(normalisation.replace.items()),
+                     normalisation.remove, normalisation.keep_given))
+    key = getattr(normalisation, 'cache_key', None)
+    if key is not None:
+        return repr(('cache_key', getattr(normalisation, '__module__', None),
+                     getattr(normalisation, '__qualname__', type(normalisation).__qualname__), key))
+    if isinstance(normalisation, BatchNormaliser):
+        return repr(('BatchNormaliser', _identity(normalisation.function), normalisation.column))
+    raise _Unidentifiable(getattr(normalisation, '__qualname__', type(normalisation).__qualname__))
+
+
+def _copy_found(found):
+    """Copy the tokens of a block, so that what is done to them once they are
+    handed out (e.g. normalisation) doesn't change the ones that are kept. The
+    values of their fields can't be changed in place, so they can be shared."""
+    return {key: [dict(t) for t in tokens] for key, tokens in found.items()}
+
+
+class BatchNormaliser:
+    """A normalisation function that works on many tokens at once, to be given as the
+    normalisation option of a Tokenizer. If column is None, the function is given a
+    list of tokens and returns the list of normalised tokens; otherwise it is given
+    the list of the values of that field of the tokens (e.g. 'n'), and returns the
+    list of their new values. The tokens come all at once for a document, or in
+    batches as they are read when the document is streamed."""
+
+    def __init__(self, function, column=None):
+        self.function = function
+        self.column = column
+
+    def batch(self, tokens):
+        if self.column is None:
+            return self.function(tokens)
+        for token, value in zip(tokens, self.function([t[self.column] for t in tokens])):
+            token[self.column] = value
+        return tokens
+
+    def __call__(self, token):
+        return self.batch([token])[0]
+
+
+# The number of tokens to normalise at once when they come one block at a time
+_BATCH_SIZE = 10000
+
+
+def _batched(iterable, size):
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if len(batch):
+        yield batch
+
+
+def write_witnesses(tokenizer, xmlfiles, out, jobs=1):
+    """Tokenize the given XML files and write the results, as the JSON witness list
+    that CollateX expects, to the binary filehandle 'out'. If jobs is more than 1,
+    that many files are tokenized at once in separate processes. Each witness is
+    written as soon as it and all the witnesses before it are done, so that the
+    output is always in the order of xmlfiles."""
+    out.write(b'{"witnesses": [')
+    with ProcessPoolExecutor(max_workers=jobs) if jobs > 1 else _Serial() as executor:
+        first = True
+        for result in executor.map(tokenizer.from_file, xmlfiles):
+            if len(result):
+                if not first:
+                    out.write(b', ')
+                out.write(json.dumps(result, ensure_ascii=False).encode('utf-8'))
+                out.flush()
+                first = False
+    out.write(b']}')
+
+
+def _runs(sizes, count):
+    """Divide a list of blocks, given by their sizes, into at most the given number
+    of runs of blocks that come one after another, each about as big as the others.
+    Returns the runs as ranges of indices into the list."""
+    total = sum(sizes)
+    runs = []
+    start = 0
+    done = 0
+    for i, size in enumerate(sizes):
+        done += size
+        if done * count >= total * (len(runs) + 1) or i == len(sizes) - 1:
+            runs.append(range(start, i + 1))
+            start = i + 1
+    return runs
+
+
+def _run_document(blocks, data):
+    """Put the serialized blocks of a run (with their tails) together into a document
+    of their own, each block inside an element of its own, so that it has a parent.
+    Any entities that they refer to are declared, so that the references are kept."""
+    names = sorted({entity.name for block in blocks for entity in block.iter(etree.Entity)})
+    doctype = b''
+    if len(names):
+        doctype = ('<!DOCTYPE blocks [%s]>' % ''.join('<!ENTITY %s "">' % name for name in names)).encode('utf-8')
+    return doctype + b'<blocks>' + b''.join(b'<block>' + d + b'</block>' for d in data) + b'</blocks>'
+
+
+def _tokenize_run(tokenizer, document, wanted, layers, starts, paths, locations, elements):
+    """Parse a run of serialized blocks, and find their raw tokens with the given
+    tokenizer, as if they were still in their document. The location each block
+    begins in is given as indices into the elements that define the locations,
+    which are given as their tags and attributes. This is what a process does for
+    _tokenize_parallel."""
+    parser = etree.XMLParser(resolve_entities=False, huge_tree=True)
+    root = etree.fromstring(document, parser)
+    blocks = [wrapper[0] for wrapper in root]
+    locators = None
+    if locations is not None:
+        elements = [etree.Element(tag, attrib) for tag, attrib in elements]
+        locators = [_Locator.placed([None if i is None else elements[i] for i in location])
+                    for location in locations]
+    index = None if wanted is None else milestone_index(root)
+    return tokenizer._tokenize_blocks(root, wanted, layers, blocks, index, starts, paths, locators)
+
+
+class _Serial:
+    """A stand-in for an executor that does its work in this process."""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def map(self, fn, *iterables):
+        return map(fn, *iterables)
+
+
 if __name__ == '__main__':
-    witness_array = []
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "-j", "--jobs",
+        type=int,
+        default=1,
+        help="Number of witnesses to tokenize in parallel",
+    )
+    parser.add_argument(
+        "-b", "--block-jobs",
+        type=int,
+        default=1,
+        help="Number of processes to tokenize the blocks of each witness in",
+    )
+    parser.add_argument(
+        "files",
+        nargs="+",
+        metavar="file",
+        help="TEI XML files to tokenize, optionally preceded by the milestone to extract",
+    )
+    args = parser.parse_args()
     textms = None
-    xmlfiles = None
-    if re.match('.*\.xml$', sys.argv[1]) is None:
-        textms = sys.argv[1]
-        xmlfiles = sys.argv[2:]
-    else:
-        xmlfiles = sys.argv[1:]
-    tok = Tokenizer(milestone=textms, first_layer=True)
-    for fn in xmlfiles:
-        result = tok.from_file(fn)
-        if len(result):
-            witness_array.append(result)
-    result = json.dumps({'witnesses': witness_array}, ensure_ascii=False)
-    sys.stdout.buffer.write(result.encode('utf-8'))
+    xmlfiles = args.files
+    if re.match('.*\.xml$', xmlfiles[0]) is None:
+        textms = xmlfiles[0]
+        xmlfiles = xmlfiles[1:]
+    tok = Tokenizer(milestone=textms, first_layer=True, jobs=args.block_jobs)
+    write_witnesses(tok, xmlfiles, sys.stdout.buffer, jobs=args.jobs)